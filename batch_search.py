@@ -0,0 +1,178 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from flight_search import FlightSearch, search_single_call, normalize_city, check_search, search_parameters
+from metrics import run_in_context
+from rate_limiter import RateLimitExceeded
+import threading
+import os
+
+# The most searches accepted in one batch request.
+BATCH_MAX_SEARCHES = int(os.environ.get("BATCH_MAX_SEARCHES", 100))
+# The most batch searches (and city lookups) this worker process runs against the Tequila API at once, across all the
+# batch requests it's serving, so a big batch can't trip the API's rate limits.
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+
+RATE_LIMITED_MESSAGE = "Too many searches are running right now, please try again in a moment."
+LOOKUP_FAILED_MESSAGE = "The city lookup failed, please try again."
+SEARCH_FAILED_MESSAGE = "The flight search failed, please try again."
+
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+
+class BatchSearchError(ValueError):
+    # Raised for a batch request that can't be run at all (as opposed to a single bad search within the batch).
+    pass
+
+
+def get_batch_executor():
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch-search")
+    return _batch_executor
+
+
+def parse_search(search):
+    # Checks one search of a batch and fills in its defaults. Raises ValueError with a message for the user if the
+    # search can't be run, using the same rules as the search form (see check_search).
+    if not isinstance(search, dict):
+        raise ValueError("Each search must be an object.")
+    for field in ("from", "to", "date_from"):
+        if not isinstance(search.get(field), str) or not search[field].strip():
+            raise ValueError(f"\"{field}\" is required.")
+    flight_type = search.get("flight_type", "round" if search.get("date_to") else "oneway")
+    if flight_type not in ("oneway", "round"):
+        raise ValueError("\"flight_type\" must be \"oneway\" or \"round\".")
+    try:
+        date_from = datetime.strptime(search["date_from"], "%Y-%m-%d").date()
+        date_to = datetime.strptime(search["date_to"], "%Y-%m-%d").date() if flight_type == "round" else None
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Dates must be given as YYYY-MM-DD, with a date_to for round trips.")
+    try:
+        adults = int(search.get("adults", 1))
+        children = int(search.get("children", 0))
+        infants = int(search.get("infants", 0))
+    except (TypeError, ValueError):
+        raise ValueError("Passenger counts must be numbers.")
+    # The form only offers at least 1 adult and no negative counts, so those are checked here.
+    if adults < 1 or children < 0 or infants < 0:
+        raise ValueError("Searches need at least 1 adult.")
+    currency = search.get("currency", "CAD")
+    if currency not in ("CAD", "USD", "EUR"):
+        raise ValueError("\"currency\" must be CAD, USD or EUR.")
+    parsed = {
+        "from": search["from"],
+        "to": search["to"],
+        "date_from": date_from,
+        "date_to": date_to,
+        "flight_type": flight_type,
+        "adults": adults,
+        "children": children,
+        "infants": infants,
+        "currency": currency,
+    }
+    check_search(parsed)
+    return parsed
+
+
+def lookup_city(city):
+    # Returns (city_name, iata_code), None if the city can't be found, or the error if the lookup couldn't be made (the
+    # API is busy, unreachable or sent back something that isn't JSON). Errors are returned rather than raised so that
+    # one failed lookup only fails the searches that need it, not the whole stream of results.
+    # requests is imported here rather than at the top, since it's only loaded once the app first searches.
+    from requests import RequestException
+    try:
+        return FlightSearch().city_iata_search(city)
+    except KeyError:
+        return None
+    except (RateLimitExceeded, RequestException, ValueError) as error:
+        return error
+
+
+def flight_json(flight):
+    if not flight:
+        return None
+    flight_output = dict(flight.as_dict())
+    flight_output["stopovers"] = flight.stopovers()
+    return flight_output
+
+
+def run_search(index, search, cities):
+    departure = cities[normalize_city(search["from"])]
+    destination = cities[normalize_city(search["to"])]
+    for city in (departure, destination):
+        if isinstance(city, RateLimitExceeded):
+            return {"index": index, "status": "error", "error": RATE_LIMITED_MESSAGE}
+        if isinstance(city, Exception):
+            return {"index": index, "status": "error", "error": LOOKUP_FAILED_MESSAGE}
+    if departure is None or destination is None:
+        missing = search["from"] if departure is None else search["to"]
+        return {"index": index, "status": "error", "error": f"The city \"{missing}\" could not be found."}
+    parameters = search_parameters(search, departure[1], destination[1])
+    from requests import RequestException
+    try:
+        most_direct_flight, cheapest_flight, flights_by_stopovers = search_single_call(parameters, destination[0])
+    except RateLimitExceeded:
+        return {"index": index, "status": "error", "error": RATE_LIMITED_MESSAGE}
+    except (KeyError, RequestException, ValueError):
+        # The API answered with an error instead of a list of flights, couldn't be reached, or its answer wasn't JSON.
+        return {"index": index, "status": "error", "error": SEARCH_FAILED_MESSAGE}
+    result = {
+        "index": index,
+        "from": {"city": departure[0], "iata": departure[1]},
+        "to": {"city": destination[0], "iata": destination[1]},
+    }
+    if not cheapest_flight:
+        result["status"] = "no_flights"
+        return result
+    result["status"] = "ok"
+    result["cheapest_flight"] = flight_json(cheapest_flight)
+    result["most_direct_flight"] = flight_json(most_direct_flight)
+    # The SINGLE_CALL_TOP_N cheapest flights for each number of stopovers, keyed by the number as a string (eg: "0"
+    # for direct flights), so clients can offer alternatives to the two flights above.
+    result["flights_by_stopovers"] = {str(stopovers): [flight_json(flight) for flight in flights]
+                                      for stopovers, flights in flights_by_stopovers.items()}
+    return result
+
+
+def run_batch(payload):
+    # Checks a batch request and returns a generator of results, one dict per search, in the order they finish
+    # (each has the "index" of its search in the request). Raises BatchSearchError if the request as a whole is bad.
+    # Every city is only looked up once for the whole batch, and the lookups and searches all go through the
+    # BATCH_CONCURRENCY limited pool. Each search makes one single-call flight search (see search_single_call).
+    if not isinstance(payload, dict) or not isinstance(payload.get("searches"), list):
+        raise BatchSearchError("The request body must be a JSON object with a \"searches\" list.")
+    if not payload["searches"]:
+        raise BatchSearchError("\"searches\" is empty.")
+    if len(payload["searches"]) > BATCH_MAX_SEARCHES:
+        raise BatchSearchError(f"A batch can have at most {BATCH_MAX_SEARCHES} searches.")
+    return batch_results(payload["searches"])
+
+
+def batch_results(raw_searches):
+    searches = {}
+    for index, search in enumerate(raw_searches):
+        try:
+            searches[index] = parse_search(search)
+        except ValueError as error:
+            yield {"index": index, "status": "error", "error": str(error)}
+
+    executor = get_batch_executor()
+    city_names = {}
+    for search in searches.values():
+        for city in (search["from"], search["to"]):
+            city_names.setdefault(normalize_city(city), city)
+    lookups = {normalize_city(city): executor.submit(run_in_context(lookup_city), city)
+               for city in city_names.values()}
+    futures = []
+    try:
+        cities = {key: lookup.result() for key, lookup in lookups.items()}
+        futures = [executor.submit(run_in_context(run_search), index, search, cities)
+                   for index, search in searches.items()]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # If the client goes away part way through, the searches that haven't started are dropped.
+        for future in list(lookups.values()) + futures:
+            future.cancel()
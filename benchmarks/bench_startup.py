@@ -0,0 +1,114 @@
+# Startup and per-request overhead benchmark. Each run starts a fresh Python process that imports the app, then sends
+# requests through Flask's test client, and reports:
+#   import      - time to import main (what each gunicorn worker pays at boot, unless the app is preloaded)
+#   first <page> - the first request for a page, which also loads the modules and templates it needs
+#   <page>       - the average time of later requests for the page, ie: the per-request overhead
+# The search page is posted with a search that's answered from the caches after the first request, so its time is the
+# app's own overhead (form, caches, parsing, rendering) without any waiting on the API. The Tequila API is the mock
+# server in mock_tequila.py, answering without any added latency.
+#
+# Each mode sets a few environment variables, see MODES. --app-dir points at another checkout of the app (eg: a git
+# worktree of an older commit) to compare against it.
+#
+# Usage: python benchmarks/bench_startup.py [--runs 5] [--requests 200] [--app-dir PATH] [--modes default,preload]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import date, timedelta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+MODES = {
+    "default": {},
+    "no-bytecode-cache": {"JINJA_BYTECODE_CACHE": "0"},
+    "preload": {"PRELOAD_APP": "1"},
+}
+
+# Runs inside the fresh process. The timings are printed as JSON on the last line.
+CHILD = """
+import json, os, sys, time
+started = time.perf_counter()
+import main
+timings = {"import": time.perf_counter() - started}
+client = main.app.test_client()
+pages = json.loads(sys.argv[1])
+for name, (method, path, data) in pages.items():
+    started = time.perf_counter()
+    response = client.open(path, method=method, data=data)
+    assert response.status_code == 200, (path, response.status_code)
+    timings["first " + name] = time.perf_counter() - started
+    requests = int(sys.argv[2])
+    started = time.perf_counter()
+    for _ in range(requests):
+        client.open(path, method=method, data=data).close()
+    timings[name] = (time.perf_counter() - started) / requests
+print(json.dumps(timings))
+"""
+
+
+def search_form():
+    depart = date.today() + timedelta(days=5)
+    return {"departure_city": "Toronto", "destination_city": "London", "date_from": depart.isoformat(),
+            "date_to": (depart + timedelta(days=7)).isoformat(), "adults": "1", "children": "0", "infants": "0",
+            "currency": "CAD", "flexible_days": "0"}
+
+
+def run_once(app_dir, env, requests):
+    pages = {
+        "home": ("GET", "/", None),
+        "search form": ("GET", "/round_trip_search", None),
+        "search": ("POST", "/round_trip_search", search_form()),
+    }
+    output = subprocess.run([sys.executable, "-c", CHILD, json.dumps(pages), str(requests)], cwd=app_dir, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def format_time(seconds):
+    if seconds >= 0.001:
+        return f"{seconds * 1000:.1f}ms"
+    return f"{seconds * 1000000:.0f}us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app's startup time and per-request overhead.")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per mode (the median is shown)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per page after the first one")
+    parser.add_argument("--app-dir", default=ROOT_DIR, help="checkout of the app to benchmark")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated modes, from: " + ", ".join(MODES))
+    parser.add_argument("--mock-port", type=int, default=8766)
+    args = parser.parse_args()
+
+    mock = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, "mock_tequila.py"),
+                             "--port", str(args.mock_port), "--latency-ms", "0", "--jitter-ms", "0"],
+                            stdout=subprocess.DEVNULL)
+    try:
+        mock_url = f"http://127.0.0.1:{args.mock_port}"
+        for _ in range(50):
+            try:
+                urllib.request.urlopen(f"{mock_url}/__stats")
+                break
+            except OSError:
+                time.sleep(0.1)
+        base_env = dict(os.environ, TEQUILA_URL=mock_url, TEQUILA_API_KEY="mock", CSRF_TOKEN="bench",
+                        TEQUILA_RATE_LIMIT_BACKEND="none", SEARCH_CACHE_BACKEND="memory")
+        for mode in args.modes.split(","):
+            env = dict(base_env, **MODES[mode])
+            # One run first so the bytecode cache (when there is one) is filled, as it would be after a restart.
+            run_once(args.app_dir, env, 1)
+            runs = [run_once(args.app_dir, env, args.requests) for _ in range(args.runs)]
+            print(f"{mode}:")
+            for name in runs[0]:
+                print(f"  {name:<20} {format_time(statistics.median(run[name] for run in runs))}")
+    finally:
+        mock.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Micro-benchmark for the itinerary time calculations: the original strptime-based time_calc pipeline against the
+# integer pipeline in itinerary.py. Both work out the flight, layover and total travel times of the same itineraries
+# and format them as strings.
+#
+# Usage: python benchmarks/bench_time_calc.py [--itineraries 200] [--segments 4] [--repeat 5]
+import argparse
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from itinerary import Itinerary, format_duration
+
+
+# The time calculations as they were written before the integer pipeline, kept here for comparison.
+def legacy_time_calc(initial_time, secondary_time):
+    initial_string = initial_time[0:10] + " " + initial_time[11:16]
+    initial_datetime = datetime.strptime(initial_string, '%Y-%m-%d %H:%M')
+
+    secondary_string = secondary_time[0:10] + " " + secondary_time[11:16]
+    secondary_datetime = datetime.strptime(secondary_string, '%Y-%m-%d %H:%M')
+    difference = secondary_datetime - initial_datetime
+    difference = str(difference)
+    difference = difference.split(":")
+    difference_string = difference[0] + "h" + difference[1] + "m"
+    return difference_string
+
+
+def legacy_total_travel_time_calc(departure_time, arrival_time, depart_return_split):
+    total_time_travel = []
+    depart_total_time = legacy_time_calc(departure_time[0], arrival_time[depart_return_split - 1])
+    return_total_time = legacy_time_calc(departure_time[depart_return_split], arrival_time[-1])
+    total_time_travel.append(depart_total_time)
+    total_time_travel.append(return_total_time)
+    return total_time_travel
+
+
+def legacy_layover_time_calc(depart_times, arrival_times):
+    layover_times = []
+    for count in range(0, (len(depart_times) - 1)):
+        layover_times.append(legacy_time_calc(arrival_times[count], depart_times[count+1]))
+    return layover_times
+
+
+def legacy_durations(route):
+    departure_time_utc = []
+    arrival_time_utc = []
+    flight_time = []
+    for segment in route:
+        departure_time_utc.append(segment["utc_departure"])
+        arrival_time_utc.append(segment["utc_arrival"])
+        flight_time.append(legacy_time_calc(segment["utc_departure"], segment["utc_arrival"]))
+    layover_time = []
+    if len(route) > 1:
+        layover_time = legacy_layover_time_calc(departure_time_utc, arrival_time_utc)
+    total_travel_time = legacy_total_travel_time_calc(departure_time_utc, arrival_time_utc, 0)
+    return flight_time, layover_time, total_travel_time
+
+
+def integer_durations(route):
+    # Same work as legacy_durations: read the times from the route, then calculate and format every duration.
+    itinerary = Itinerary({"price": 100, "route": route}, {"curr": "CAD", "flight_type": "oneway"}, None)
+    flight_times, layover_times, total_travel_times = itinerary.durations()
+    return ([format_duration(seconds) for seconds in flight_times],
+            [format_duration(seconds) for seconds in layover_times],
+            [format_duration(seconds) for seconds in total_travel_times])
+
+
+def make_routes(count, segments, seed=0):
+    rng = random.Random(seed)
+    routes = []
+    for _ in range(count):
+        departure = datetime(2026, 11, 3, rng.randint(0, 23), rng.choice((0, 5, 15, 30, 45)))
+        route = []
+        for _ in range(segments):
+            arrival = departure + timedelta(minutes=rng.randint(45, 14 * 60))
+            route.append({
+                "cityFrom": "A", "cityCodeFrom": "AAA", "cityTo": "B", "cityCodeTo": "BBB",
+                "local_departure": departure.strftime("%Y-%m-%dT%H:%M:00.000Z"),
+                "local_arrival": arrival.strftime("%Y-%m-%dT%H:%M:00.000Z"),
+                "utc_departure": departure.strftime("%Y-%m-%dT%H:%M:00.000Z"),
+                "utc_arrival": arrival.strftime("%Y-%m-%dT%H:%M:00.000Z"),
+                "airline": "AC", "flight_no": 100,
+            })
+            departure = arrival + timedelta(minutes=rng.randint(40, 20 * 60))
+        routes.append(route)
+    return routes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the itinerary time calculations.")
+    parser.add_argument("--itineraries", type=int, default=200)
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    routes = make_routes(args.itineraries, args.segments)
+
+    # Both pipelines have to agree before their speed is worth comparing. The legacy code writes durations of a day
+    # or more as "1 day, 3h05m", so those are left out of the check.
+    for route in routes:
+        for legacy, integer in zip(legacy_durations(route), integer_durations(route)):
+            for legacy_value, integer_value in zip(legacy, integer):
+                assert "day" in legacy_value or legacy_value == integer_value, (legacy_value, integer_value)
+
+    results = {}
+    for name, function in (("legacy strptime", legacy_durations), ("integer", integer_durations)):
+        timings = timeit.repeat(lambda: [function(route) for route in routes], number=1, repeat=args.repeat)
+        results[name] = min(timings)
+        print(f"{name:>16}: {min(timings) * 1000:8.2f} ms for {args.itineraries} itineraries "
+              f"({min(timings) / args.itineraries * 1e6:6.1f} us each)")
+    print(f"{'speedup':>16}: {results['legacy strptime'] / results['integer']:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
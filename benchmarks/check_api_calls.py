@@ -0,0 +1,151 @@
+# Checks the pieces that decide when a call to the Tequila API is made: the token buckets (TokenBucket, and
+# SQLiteTokenBucket shared between processes) and SingleFlight. The buckets run on a fake clock, so the waits they
+# hand out are exact, and SingleFlight's leader is held until every follower has joined its call.
+#
+# Usage: python benchmarks/check_api_calls.py
+import math
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rate_limiter
+from cache import SingleFlight
+from rate_limiter import RateLimitExceeded, SQLiteTokenBucket, TokenBucket
+
+
+class FakeClock:
+    # Stands in for the time module in rate_limiter. sleep() moves the clock on instead of waiting.
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def same_wait(wait, expected):
+    return wait is expected if expected is None else wait is not None and math.isclose(wait, expected, abs_tol=1e-9)
+
+
+def check_bucket(bucket, clock):
+    # 10 calls a second, bursts of 2 and at most 0.25s of waiting. The burst goes through straight away, then each
+    # call waits 0.1s longer than the last, until the wait would be over max_wait and the call is turned away without
+    # taking a token.
+    waits = [bucket.reserve() for _ in range(6)]
+    for wait, expected in zip(waits, (0.0, 0.0, 0.1, 0.2, None, None)):
+        assert same_wait(wait, expected), waits
+    # 0.1s later one token has come back, so the next call is served where the first turned away call would have
+    # been (the bucket is at -2 again, 0.2s of waiting).
+    clock.now += 0.1
+    wait = bucket.reserve()
+    assert same_wait(wait, 0.2), wait
+    # acquire() raises instead of waiting 0.3s, and sleeps for its turn when it's within max_wait.
+    try:
+        bucket.acquire()
+    except RateLimitExceeded:
+        pass
+    else:
+        raise AssertionError("acquire() didn't raise RateLimitExceeded over max_wait")
+    clock.now += 0.1
+    wait = bucket.acquire()
+    assert same_wait(wait, 0.2) and same_wait(clock.sleeps[-1], 0.2), (wait, clock.sleeps)
+    # A long idle refills the bucket up to burst, and no further.
+    clock.now += 60
+    waits = [bucket.reserve() for _ in range(3)]
+    for wait, expected in zip(waits, (0.0, 0.0, 0.1)):
+        assert same_wait(wait, expected), waits
+    stats = bucket.stats()
+    assert stats["rejected"] == 1 and stats["acquired"] == 1 and stats["delayed"] == 1, stats
+
+
+def check_token_buckets():
+    clock = FakeClock()
+    real_time = rate_limiter.time
+    rate_limiter.time = clock
+    try:
+        check_bucket(TokenBucket(10, 2, max_wait=0.25), clock)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rate_limit.db")
+            check_bucket(SQLiteTokenBucket(path, "check", 10, 2, max_wait=0.25), clock)
+            # Two buckets on the same file and name (eg: two gunicorn workers) take from the same tokens.
+            clock.now += 60
+            first = SQLiteTokenBucket(path, "shared", 10, 2, max_wait=0.25)
+            second = SQLiteTokenBucket(path, "shared", 10, 2, max_wait=0.25)
+            waits = [first.reserve(), first.reserve(), second.reserve(), second.reserve()]
+            for wait, expected in zip(waits, (0.0, 0.0, 0.1, 0.2)):
+                assert same_wait(wait, expected), waits
+    finally:
+        rate_limiter.time = real_time
+
+
+def run_coalesced(outcome, followers=5):
+    # Runs one leader and followers calls of the same key. The leader's fetch holds on until every follower has
+    # joined its call, then returns (or raises) outcome. Returns (the number of fetches, what each call got back).
+    flight = SingleFlight()
+    fetched = []
+    started = threading.Event()
+    release = threading.Event()
+    results = {}
+
+    def fetch():
+        fetched.append(1)
+        started.set()
+        assert release.wait(10), "the followers never joined"
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    def call(name):
+        try:
+            results[name] = ("result", flight.do("key", fetch))
+        except BaseException as error:
+            results[name] = ("error", error)
+
+    threads = [threading.Thread(target=call, args=("leader",))]
+    threads[0].start()
+    assert started.wait(10), "the leader never fetched"
+    threads += [threading.Thread(target=call, args=(f"follower {index}",)) for index in range(followers)]
+    for thread in threads[1:]:
+        thread.start()
+    # Followers are counted as they join the leader's call, before they wait for it.
+    while flight.stats()["coalesced"] < followers:
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+    assert not flight.calls, "the call was left behind once it finished"
+    return len(fetched), results
+
+
+def check_single_flight():
+    value = {"data": []}
+    fetches, results = run_coalesced(value)
+    assert fetches == 1, fetches
+    assert all(kind == "result" and result is value for kind, result in results.values()), results
+
+    error = ValueError("bad response")
+    fetches, results = run_coalesced(error)
+    assert fetches == 1, fetches
+    assert all(kind == "error" and result is error for kind, result in results.values()), results
+
+    # Once a call has finished, the next one for the key fetches again rather than reusing the last result.
+    flight = SingleFlight()
+    assert flight.do("key", lambda: 1) == 1 and flight.do("key", lambda: 2) == 2
+    assert flight.stats() == {"calls": 2, "coalesced": 0}, flight.stats()
+
+
+def main():
+    check_token_buckets()
+    check_single_flight()
+    print("OK: token buckets and SingleFlight")
+
+
+if __name__ == "__main__":
+    main()
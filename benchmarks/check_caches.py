@@ -0,0 +1,136 @@
+# Checks the caches in front of the Tequila API: StaleWhileRevalidateCache (the search cache, on an LRUCache or a
+# SQLiteCache) and TieredCache (the city lookup cache). The caches run on a fake clock, so entries go from fresh to
+# stale to expired exactly when expected, and background refreshes are held until the check lets them finish.
+#
+# Usage: python benchmarks/check_caches.py
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cache
+from cache import MISSING, LRUCache, SQLiteCache, StaleWhileRevalidateCache, TieredCache
+
+
+class FakeClock:
+    # Stands in for the time module in cache.
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def wait_for(condition, message):
+    for _ in range(10000):
+        if condition():
+            return
+        threading.Event().wait(0.001)
+    raise AssertionError(message)
+
+
+class Fetcher:
+    # A fetch that counts its calls and returns (or raises) the next outcome. When hold is set, each call waits for
+    # release first, so a background refresh can be caught while it's running.
+    def __init__(self, *outcomes, hold=False):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def __call__(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        assert self.release.wait(10), "the refresh was never released"
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def check_stale_while_revalidate(backend, clock):
+    # Fresh for 10s, then served stale for 20s more while one background refresh runs.
+    search_cache = StaleWhileRevalidateCache(backend, 10, 20, should_cache=lambda flights: "data" in flights)
+    first, second, third = {"data": [1]}, {"data": [2]}, {"data": [3]}
+    fetch = Fetcher(first, third)
+    assert search_cache.get_or_fetch("key", fetch) == first and fetch.calls == 1
+    clock.now += 5
+    assert search_cache.get_or_fetch("key", fetch) == first and fetch.calls == 1
+
+    # Stale: the old value is served straight away, and only one refresh runs however many stale hits there are.
+    # Background refreshes use refresh_fetch when it's given.
+    clock.now += 10
+    refresh = Fetcher(second, hold=True)
+    assert search_cache.get_or_fetch("key", fetch, refresh_fetch=refresh) == first
+    wait_for(lambda: refresh.calls == 1, "the stale hit didn't start a refresh")
+    clock.now += 1
+    assert search_cache.get_or_fetch("key", fetch, refresh_fetch=refresh) == first
+    refresh.release.set()
+    wait_for(lambda: not search_cache.refreshing, "the refresh never finished")
+    assert refresh.calls == 1 and fetch.calls == 1, (refresh.calls, fetch.calls)
+    assert search_cache.get_or_fetch("key", fetch) == second and fetch.calls == 1
+
+    # A failed refresh leaves the stale value in place, and the next stale hit tries again.
+    clock.now += 15
+    failing = Fetcher(ValueError("API down"))
+    assert search_cache.get_or_fetch("key", fetch, refresh_fetch=failing) == second
+    wait_for(lambda: search_cache.stats()["refresh_errors"] == 1, "the failed refresh wasn't counted")
+    wait_for(lambda: not search_cache.refreshing, "the failed refresh never finished")
+    retry = Fetcher(second)
+    assert search_cache.get_or_fetch("key", fetch, refresh_fetch=retry) == second
+    wait_for(lambda: retry.calls == 1 and not search_cache.refreshing, "the refresh wasn't retried")
+
+    # Expired: 30s after it was last stored, the entry is gone and the caller fetches.
+    clock.now += 31
+    assert search_cache.get_or_fetch("key", fetch) == third and fetch.calls == 2
+
+    # Results should_cache turns down (API errors) are returned but never stored, so the next call fetches again.
+    error = {"error": "rate limited"}
+    failing = Fetcher(error, error)
+    assert search_cache.get_or_fetch("error", failing) == error
+    assert search_cache.get_or_fetch("error", failing) == error and failing.calls == 2
+
+    stats = search_cache.stats()
+    expected = {"fresh_hits": 2, "stale_hits": 4, "misses": 4, "refreshes": 2, "refresh_errors": 1}
+    assert stats == expected, stats
+
+
+def check_tiered_cache(path, clock):
+    # A city the API doesn't know about is cached as None for the negative TTL. Another worker (a new in-memory
+    # tier on the same file) finds it on disk, and copies it into memory with what's left of its lifetime.
+    started = clock.now
+    disk = SQLiteCache(path, "iata_cache", 100)
+    TieredCache(LRUCache(10, 100), disk).set("atlantis", None, ttl=10)
+    clock.now += 4
+    memory = LRUCache(10, 100)
+    iata_cache = TieredCache(memory, disk)
+    assert iata_cache.get("atlantis") is None
+    assert memory.entries["atlantis"] == (None, started + 10), memory.entries["atlantis"]
+    clock.now += 1
+    assert iata_cache.get("atlantis") is None
+    # Past the negative TTL it's gone from both tiers, so the API is asked again.
+    clock.now += 6
+    assert iata_cache.get("atlantis") is MISSING
+    stats = iata_cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["misses"], stats["negative_hits"]) == (1, 1, 1, 2), stats
+
+
+def main():
+    clock = FakeClock()
+    real_time = cache.time
+    cache.time = clock
+    try:
+        check_stale_while_revalidate(LRUCache(64, 30), clock)
+        with tempfile.TemporaryDirectory() as directory:
+            check_stale_while_revalidate(SQLiteCache(os.path.join(directory, "search_cache.db"), "search_cache", 30),
+                                         clock)
+            check_tiered_cache(os.path.join(directory, "iata_cache.db"), clock)
+    finally:
+        cache.time = real_time
+    print("OK: StaleWhileRevalidateCache and TieredCache")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Checks the rules the concurrent stopover search stops on (stopover_tiers_settled) and builds its answer with
+# (reduce_stopover_tiers) against the sequential search, which always waits for every tier. Random searches are made
+# up from a seeded list of flights, with each tier returning the cheapest flight with at most its number of stopovers,
+# like the API. For every order the tiers could come back in, the answer at the point the concurrent search stops
+# must match the sequential answer: the same most direct flight, and a cheapest flight with the same price (another
+# flight with the same price may be picked when the tiers holding it never came back).
+#
+# Usage: python benchmarks/check_stopover_tiers.py [--searches 300] [--seed 1]
+import argparse
+import itertools
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# flight_search reads its settings when it's imported. No calls are made, so the key is never used.
+os.environ.setdefault("TEQUILA_API_KEY", "check")
+os.environ.setdefault("TEQUILA_RATE_LIMIT_BACKEND", "none")
+os.environ.setdefault("SEARCH_CACHE_BACKEND", "none")
+
+from flight_search import MAX_STOPOVERS, reduce_stopover_tiers, stopover_tiers_settled
+
+
+class Flight:
+    # Stands in for an Itinerary: the search rules only read the price.
+    def __init__(self, name, stopovers, price):
+        self.name = name
+        self.stopovers = stopovers
+        self.price = price
+
+    def __repr__(self):
+        return f"{self.name}({self.stopovers} stops, {self.price})"
+
+
+def make_tiers(rng, max_stopovers):
+    # The flight each tier returns (or None), from up to 8 flights. Prices are drawn from a short list so that ties
+    # come up, and some flights have more stopovers than any tier allows.
+    flights = [Flight(f"F{index}", rng.randint(0, max_stopovers + 1), rng.choice(range(100, 1000, 50)))
+               for index in range(rng.randint(0, 8))]
+    tiers = {}
+    for stopovers in range(0, max_stopovers + 1):
+        allowed = [flight for flight in flights if flight.stopovers <= stopovers]
+        tiers[stopovers] = min(allowed, key=lambda flight: (flight.price, flight.stopovers), default=None)
+    return tiers
+
+
+def check_search(tiers, max_stopovers):
+    # Returns the number of arrival orders checked.
+    expected_direct, expected_cheapest = reduce_stopover_tiers(tiers)
+    orders = 0
+    for order in itertools.permutations(tiers):
+        tier_results = {}
+        for stopovers in order:
+            tier_results[stopovers] = tiers[stopovers]
+            if stopover_tiers_settled(tier_results, max_stopovers):
+                break
+        # Every tier coming back always settles the search, so the concurrent search never stops short of that.
+        assert stopover_tiers_settled(tier_results, max_stopovers), (tiers, order)
+        most_direct_flight, cheapest_flight = reduce_stopover_tiers(tier_results)
+        # Both are empty dicts when no tier found a flight.
+        assert bool(most_direct_flight) == bool(expected_direct), (tiers, order, most_direct_flight, expected_direct)
+        assert bool(cheapest_flight) == bool(expected_cheapest), (tiers, order, cheapest_flight, expected_cheapest)
+        if expected_direct:
+            assert most_direct_flight is expected_direct, (tiers, order, most_direct_flight, expected_direct)
+            assert cheapest_flight.price == expected_cheapest.price, (tiers, order, cheapest_flight, expected_cheapest)
+        orders += 1
+    return orders
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the concurrent stopover search's stopping rules.")
+    parser.add_argument("--searches", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    orders = 0
+    # The searches with no flights at all, and with every tier finding the same flight, are always checked.
+    searches = [{stopovers: None for stopovers in range(0, MAX_STOPOVERS + 1)},
+                {stopovers: Flight("F0", 0, 500) for stopovers in range(0, MAX_STOPOVERS + 1)}]
+    searches += [make_tiers(rng, MAX_STOPOVERS) for _ in range(args.searches)]
+    for tiers in searches:
+        orders += check_search(tiers, MAX_STOPOVERS)
+    print(f"OK: {len(searches)} searches, {orders} arrival orders")
+
+
+if __name__ == "__main__":
+    main()
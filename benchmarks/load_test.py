@@ -0,0 +1,186 @@
+# Load test for the /<trip_type>_trip_search endpoint. Starts mock_tequila.py and the app under gunicorn (pointed at
+# the mock with TEQUILA_URL), then sends searches from --concurrency client threads and reports throughput, latency
+# percentiles and the Tequila API calls made per user search.
+#
+# Searches cycle through --distinct-searches departure dates, so the result caches see a realistic mix of repeated
+# and new searches. Settings for the app are passed with --env, eg: to compare the two search modes:
+#
+#   python benchmarks/load_test.py --requests 200 --concurrency 8
+#   python benchmarks/load_test.py --requests 200 --concurrency 8 --env SINGLE_CALL_SEARCH=1
+#
+# or sync workers against gevent workers (see gunicorn.conf.py):
+#
+#   python benchmarks/load_test.py --requests 200 --concurrency 40 --workers 1 --env GUNICORN_WORKER_CLASS=gevent
+#
+# Use --app-url to test an app that's already running (it should be using the mock started with --mock-port).
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, timedelta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def wait_for(url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except urllib.error.HTTPError:
+            return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(percent / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def search_form(number, args):
+    depart = date.today() + timedelta(days=1 + number % args.distinct_searches)
+    form = {
+        "departure_city": args.departure_city,
+        "destination_city": args.destination_city,
+        "adults": "1",
+        "children": "0",
+        "infants": "0",
+        "date_from": depart.isoformat(),
+        "date_to": (depart + timedelta(days=7)).isoformat(),
+        "currency": "CAD",
+        "submit": "Search Flights",
+    }
+    return urllib.parse.urlencode(form).encode()
+
+
+def run_clients(args, app_url):
+    url = f"{app_url}/{args.trip_type}_trip_search"
+    next_request = iter(range(args.requests))
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def client():
+        while True:
+            with lock:
+                number = next(next_request, None)
+            if number is None:
+                return
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(url, data=search_form(number, args), timeout=args.timeout) as response:
+                    body = response.read()
+                    ok = response.status == 200 and b"Sorry, there are no available flights" not in body
+            except (urllib.error.URLError, ConnectionError, OSError) as error:
+                ok = False
+                body = str(error).encode()
+            elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors.append(body[:200])
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the trip search endpoint against the mock Tequila API.")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--distinct-searches", type=int, default=50)
+    parser.add_argument("--trip-type", choices=("oneway", "round"), default="round")
+    parser.add_argument("--departure-city", default="Toronto")
+    parser.add_argument("--destination-city", default="London")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--gunicorn-args", default="", help="extra arguments for gunicorn, eg: \"-k gthread\"")
+    parser.add_argument("--app-port", type=int, default=8766)
+    parser.add_argument("--app-url", default=None)
+    parser.add_argument("--mock-port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--env", action="append", default=[], help="NAME=VALUE setting for the app (repeatable)")
+    args = parser.parse_args()
+
+    processes = []
+    try:
+        mock_url = f"http://127.0.0.1:{args.mock_port}"
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(BENCHMARKS_DIR, "mock_tequila.py"), "--port", str(args.mock_port),
+             "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+             "--error-rate", str(args.error_rate), "--seed", "0"],
+            stdout=subprocess.DEVNULL))
+        wait_for(f"{mock_url}/__stats")
+
+        app_url = args.app_url
+        if app_url is None:
+            app_url = f"http://127.0.0.1:{args.app_port}"
+            env = dict(os.environ, TEQUILA_URL=mock_url, TEQUILA_API_KEY="mock", CSRF_TOKEN="load-test")
+            # The Tequila rate limiter would cap the throughput being measured, so it's off unless --env turns it on.
+            env.setdefault("TEQUILA_RATE_LIMIT_BACKEND", "none")
+            for setting in args.env:
+                name, value = setting.split("=", 1)
+                env[name] = value
+            processes.append(subprocess.Popen(
+                ["gunicorn", "main:app", "--bind", f"127.0.0.1:{args.app_port}", "--workers", str(args.workers),
+                 "--log-level", "warning"] + args.gunicorn_args.split(),
+                cwd=ROOT_DIR, env=env))
+            wait_for(app_url)
+
+        # The first search of each worker pays for imports and connections, so one search is made before the test.
+        urllib.request.urlopen(f"{app_url}/{args.trip_type}_trip_search", data=search_form(-1, args),
+                               timeout=args.timeout).read()
+        urllib.request.urlopen(f"{mock_url}/__reset").read()
+
+        latencies, errors, elapsed = run_clients(args, app_url)
+        calls = get_json(f"{mock_url}/__stats")
+    finally:
+        for process in reversed(processes):
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+    searches = len(latencies) + len(errors)
+    report = [
+        ("searches", f"{searches} ({len(errors)} failed) with {args.concurrency} clients"),
+        ("throughput", f"{searches / elapsed:.2f} searches/s over {elapsed:.2f}s"),
+        ("latency p50", f"{percentile(latencies, 50) * 1000:.0f} ms"),
+        ("latency p95", f"{percentile(latencies, 95) * 1000:.0f} ms"),
+        ("latency p99", f"{percentile(latencies, 99) * 1000:.0f} ms"),
+    ]
+    for path, count in sorted(calls.items()):
+        report.append((f"{path} calls", f"{count / searches if searches else 0:.2f} per search ({count} total)"))
+    if errors:
+        report.append(("first failure", repr(errors[0])))
+    for label, value in report:
+        print(f"{label + ':':<24}{value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Writes the fixtures served by mock_tequila.py: locations.json (responses of /locations/query, by search term) and
+# search_oneway.json / search_round.json (responses of /v2/search). The responses have the same shape as the Tequila
+# API's, with a deterministic mix of prices and stopovers, so that every stopover tier of a search finds something to
+# compare. Responses recorded from the real API (mock_tequila.py --record) can be used in their place.
+#
+# Usage: python benchmarks/make_fixtures.py [--itineraries 60] [--seed 1]
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+ORIGIN = ("Toronto", "YTO")
+DESTINATION = ("London", "LON")
+HUBS = [("Chicago", "CHI"), ("Paris", "PAR"), ("Frankfurt", "FRA"), ("Dubai", "DXB"), ("Madrid", "MAD"),
+        ("Reykjavik", "REK"), ("Montreal", "YMQ")]
+AIRLINES = ["AC", "BA", "LH", "AF", "IB", "FI", "EK"]
+
+
+def timestamp(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def make_sector(rng, origin, destination, stops, departure, is_return):
+    route = []
+    path = [origin] + rng.sample(HUBS, stops) + [destination]
+    for city_from, city_to in zip(path, path[1:]):
+        arrival = departure + timedelta(minutes=rng.randint(55, 9 * 60))
+        route.append({
+            "cityFrom": city_from[0],
+            "cityCodeFrom": city_from[1],
+            "cityTo": city_to[0],
+            "cityCodeTo": city_to[1],
+            "local_departure": timestamp(departure),
+            "local_arrival": timestamp(arrival),
+            "utc_departure": timestamp(departure),
+            "utc_arrival": timestamp(arrival),
+            "airline": rng.choice(AIRLINES),
+            "flight_no": rng.randint(1, 1999),
+            "return": is_return,
+        })
+        departure = arrival + timedelta(minutes=rng.randint(45, 16 * 60))
+    return route
+
+
+def make_search(rng, round_trip, itineraries):
+    data = []
+    for _ in range(itineraries):
+        # Flights with more stops tend to be cheaper, like the real results.
+        stops = rng.choice((0, 1, 1, 2, 2, 3, 4))
+        price = rng.randint(350, 1400) - stops * rng.randint(40, 120)
+        departure = datetime(2026, 11, 3, rng.randint(6, 22), rng.choice((0, 15, 30, 45)))
+        route = make_sector(rng, ORIGIN, DESTINATION, stops, departure, 0)
+        if round_trip:
+            return_stops = rng.choice((0, 1, 1, 2, 3))
+            price += rng.randint(200, 900) - return_stops * rng.randint(40, 120)
+            departure = datetime(2026, 11, 10, rng.randint(6, 22), rng.choice((0, 15, 30, 45)))
+            route += make_sector(rng, DESTINATION, ORIGIN, return_stops, departure, 1)
+        data.append({"price": max(price, 99), "route": route})
+    data.sort(key=lambda itinerary: itinerary["price"])
+    return {"data": data}
+
+
+def make_locations():
+    locations = {}
+    for name, code in [ORIGIN, DESTINATION] + HUBS:
+        locations[name.lower()] = {"locations": [{"name": name, "code": code}]}
+        locations[code.lower()] = {"locations": [{"name": name, "code": code, "city": {"name": name}}]}
+    return locations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the mock Tequila API fixtures.")
+    parser.add_argument("--itineraries", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    fixtures = {
+        "locations.json": make_locations(),
+        "search_oneway.json": make_search(rng, False, args.itineraries),
+        "search_round.json": make_search(rng, True, args.itineraries),
+    }
+    for file_name, fixture in fixtures.items():
+        with open(os.path.join(FIXTURES_DIR, file_name), "w") as file:
+            json.dump(fixture, file, separators=(",", ":"))
+        print(f"Wrote {os.path.join(FIXTURES_DIR, file_name)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# A local stand-in for the Tequila API, serving the fixtures in benchmarks/fixtures (see make_fixtures.py).
+#
+#   /locations/query  answers from locations.json by search term, and makes up a city for unknown terms.
+#   /v2/search        answers from search_<flight_type>.json, keeping only itineraries allowed by
+#                     max_sector_stopovers and cutting the list down to limit, like the real API.
+#   /__stats          JSON counts of the requests served per path (GET), reset with /__reset.
+#
+# Every response is delayed by --latency-ms (+/- --jitter-ms), and --error-rate of the API requests are answered with
+# --error-status instead, to exercise the client's retries.
+#
+# With --record, requests are passed through to the real API (TEQUILA_API_KEY must be set) and the responses are
+# saved as fixtures, so the benchmarks can be replayed against recorded data.
+#
+# Usage: python benchmarks/mock_tequila.py [--port 8765] [--latency-ms 300] [--jitter-ms 100] [--error-rate 0.0]
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+TEQUILA_URL = "https://tequila-api.kiwi.com"
+
+
+def load_fixture(fixtures_dir, file_name):
+    with open(os.path.join(fixtures_dir, file_name)) as file:
+        return json.load(file)
+
+
+def sector_stopovers(itinerary):
+    # The most stops on either the departure or the return flight of an itinerary.
+    departure_segments = sum(1 for segment in itinerary["route"] if not segment.get("return"))
+    return_segments = len(itinerary["route"]) - departure_segments
+    return max(departure_segments - 1, return_segments - 1)
+
+
+class MockTequila:
+    def __init__(self, fixtures_dir, latency_ms, jitter_ms, error_rate, error_status, record, seed=None):
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.record = record
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.locations = {}
+        self.searches = {}
+        if os.path.exists(os.path.join(fixtures_dir, "locations.json")):
+            self.locations = load_fixture(fixtures_dir, "locations.json")
+        for flight_type in ("oneway", "round"):
+            file_name = f"search_{flight_type}.json"
+            if os.path.exists(os.path.join(fixtures_dir, file_name)):
+                self.searches[flight_type] = load_fixture(fixtures_dir, file_name)
+
+    def count(self, path):
+        with self.lock:
+            self.counts[path] = self.counts.get(path, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+
+    def delay(self):
+        with self.lock:
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            fail = self.random.random() < self.error_rate
+        time.sleep(max(delay, 0))
+        return fail
+
+    def locations_query(self, parameters):
+        term = " ".join(parameters.get("term", "").split()).lower()
+        if self.record:
+            response = self.forward("/locations/query", parameters)
+            self.locations[term] = response
+            self.save("locations.json", self.locations)
+            return response
+        if term in self.locations:
+            return self.locations[term]
+        if not term or term == "nowhere":
+            return {"locations": []}
+        name = term.title()
+        code = term[:3].upper()
+        return {"locations": [{"name": name, "code": code, "city": {"name": name}}]}
+
+    def search(self, parameters):
+        flight_type = parameters.get("flight_type", "oneway")
+        if self.record:
+            response = self.forward("/v2/search", parameters)
+            # The recording made with the most stopovers allowed covers every tier.
+            stored = self.searches.get(flight_type)
+            if stored is None or len(response.get("data", [])) >= len(stored.get("data", [])):
+                self.searches[flight_type] = response
+                self.save(f"search_{flight_type}.json", response)
+            return response
+        itineraries = self.searches.get(flight_type, {"data": []})["data"]
+        max_stopovers = int(parameters.get("max_sector_stopovers", 99))
+        data = [itinerary for itinerary in itineraries if sector_stopovers(itinerary) <= max_stopovers]
+        if "limit" in parameters:
+            data = data[:int(parameters["limit"])]
+        currency = parameters.get("curr", "EUR")
+        return {"currency": currency, "data": data, "search_id": "mock"}
+
+    def forward(self, path, parameters):
+        import requests
+        response = requests.get(f"{TEQUILA_URL}{path}", params=parameters,
+                                headers={"apikey": os.environ["TEQUILA_API_KEY"]}, timeout=30)
+        return response.json()
+
+    def save(self, file_name, fixture):
+        with open(os.path.join(self.fixtures_dir, file_name), "w") as file:
+            json.dump(fixture, file, separators=(",", ":"))
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parameters = dict(parse_qsl(url.query))
+            if url.path == "/__stats":
+                return self.send_json(200, mock.stats())
+            if url.path == "/__reset":
+                mock.reset()
+                return self.send_json(200, {})
+            if url.path not in ("/locations/query", "/v2/search"):
+                return self.send_json(404, {"message": "Not found"})
+            mock.count(url.path)
+            if mock.delay():
+                return self.send_json(mock.error_status, {"message": "Mock error"})
+            if url.path == "/locations/query":
+                return self.send_json(200, mock.locations_query(parameters))
+            return self.send_json(200, mock.search(parameters))
+
+    return Handler
+
+
+def serve(port, mock):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(mock))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Tequila API fixtures locally.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fixtures", default=FIXTURES_DIR)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--record", action="store_true")
+    args = parser.parse_args()
+
+    mock = MockTequila(args.fixtures, args.latency_ms, args.jitter_ms, args.error_rate, args.error_status,
+                       args.record, args.seed)
+    server = serve(args.port, mock)
+    print(f"Mock Tequila API listening on http://127.0.0.1:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
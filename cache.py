@@ -0,0 +1,297 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+import sqlite3
+import json
+import time
+import sys
+import os
+
+# Returned by the caches when a key isn't stored (or has expired). None can't be used for this, since None is a valid
+# cached value (eg: a negative result for a city the API doesn't know about).
+MISSING = object()
+
+
+class LRUCache:
+    # In-process cache holding at most max_size entries. Each entry expires ttl seconds after it's set, and when the
+    # cache is full the least recently used entry is evicted.
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def get_with_expiry(self, key):
+        # Like get, but returns (value, expires_at) so callers can tell how fresh the entry is.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING, 0
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def gevent_patched():
+    # gevent is only loaded by gunicorn.conf.py's monkey patching, so it's only asked once it's been imported.
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+class SQLiteConnections:
+    # Opens the connections to a SQLite file, running the schema statements (eg: CREATE TABLE IF NOT EXISTS) on each
+    # new connection. sqlite3 connections can't be shared between threads, and must not be carried across a fork, so
+    # each thread of each process opens its own. Under gevent threading.local is per greenlet, which would open a
+    # connection for every search, so the process shares one instead: greenlets only switch while waiting on I/O,
+    # never inside a sqlite3 call, so their statements and transactions can't interleave.
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.local = threading.local()
+        self.shared = None
+        self.shared_pid = None
+
+    def open(self):
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        for statement in self.schema:
+            connection.execute(statement)
+        return connection
+
+    def get(self):
+        pid = os.getpid()
+        if gevent_patched():
+            if self.shared_pid != pid:
+                self.shared = self.open()
+                self.shared_pid = pid
+            return self.shared
+        if getattr(self.local, "pid", None) != pid:
+            self.local.connection = self.open()
+            self.local.pid = pid
+        return self.local.connection
+
+
+class SQLiteCache:
+    # Cache stored in a SQLite file, so that every gunicorn worker on the machine shares the same entries. Values are
+    # stored as JSON. Expired rows are purged every purge_every writes, and the table is trimmed to max_rows by
+    # dropping the entries closest to expiring.
+    def __init__(self, path, table, ttl, max_rows=10000, purge_every=100):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.purge_every = purge_every
+        self.writes = 0
+        self.connections = SQLiteConnections(path, [
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)",
+            f"CREATE INDEX IF NOT EXISTS {table}_expires_at ON {table} (expires_at)",
+        ])
+
+    def get(self, key):
+        return self.get_with_expiry(key, include_expired=False)[0]
+
+    def get_with_expiry(self, key, include_expired=True):
+        row = self.connections.get().execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?",
+                                        (key,)).fetchone()
+        if row is None or (not include_expired and row[1] <= time.time()):
+            return MISSING, 0
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        connection = self.connections.get()
+        connection.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                           (key, json.dumps(value), expires_at))
+        self.writes += 1
+        if self.writes % self.purge_every == 0:
+            self.purge(connection)
+
+    def delete(self, key):
+        self.connections.get().execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def purge(self, connection):
+        connection.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),))
+        connection.execute(f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} "
+                           f"ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+
+
+class TieredCache:
+    # An in-process LRUCache in front of an optional shared SQLiteCache. Entries found on disk are copied into
+    # memory with their remaining lifetime. Keeps hit/miss counters for each tier.
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "negative_hits": 0}
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not MISSING:
+            self.count("memory_hits")
+        elif self.disk is not None:
+            value, expires_at = self.disk.get_with_expiry(key, include_expired=False)
+            if value is not MISSING:
+                self.count("disk_hits")
+                self.memory.set(key, value, expires_at=expires_at)
+        if value is MISSING:
+            self.count("misses")
+        elif value is None:
+            self.count("negative_hits")
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.memory.ttl if ttl is None else ttl)
+        self.memory.set(key, value, expires_at=expires_at)
+        if self.disk is not None:
+            self.disk.set(key, value, expires_at=expires_at)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        stats["memory_entries"] = len(self.memory)
+        return stats
+
+
+class StaleWhileRevalidateCache:
+    # Cache for slow upstream results. An entry is fresh for fresh_ttl seconds and is then served stale for up to
+    # stale_ttl more seconds while a background refresh fetches a new copy. The backend is any cache with
+    # get_with_expiry and set (LRUCache for a single process, SQLiteCache to share entries between workers).
+    # should_cache decides whether a fetched result is worth keeping (eg: not an API error).
+    def __init__(self, backend, fresh_ttl, stale_ttl, should_cache=None, refresh_threads=2):
+        self.backend = backend
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.should_cache = should_cache or (lambda result: True)
+        self.refresh_threads = refresh_threads
+        self.refresh_executor = None
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.counters = {"fresh_hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0}
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get_or_fetch(self, key, fetch, refresh_fetch=None):
+        # refresh_fetch is used instead of fetch for background refreshes, for fetches that depend on the caller (eg:
+        # that give up once the caller no longer needs the result).
+        entry, expires_at = self.backend.get_with_expiry(key)
+        now = time.time()
+        if entry is not MISSING and expires_at > now:
+            if entry["fresh_until"] > now:
+                self.count("fresh_hits")
+            else:
+                self.count("stale_hits")
+                self.revalidate(key, refresh_fetch or fetch)
+            return entry["value"]
+        self.count("misses")
+        result = fetch()
+        self.store(key, result)
+        return result
+
+    def store(self, key, result):
+        if self.should_cache(result):
+            fresh_until = time.time() + self.fresh_ttl
+            self.backend.set(key, {"fresh_until": fresh_until, "value": result},
+                             expires_at=fresh_until + self.stale_ttl)
+
+    def revalidate(self, key, fetch):
+        # Only one refresh per key runs at a time in this process.
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+            if self.refresh_executor is None:
+                self.refresh_executor = ThreadPoolExecutor(max_workers=self.refresh_threads,
+                                                           thread_name_prefix="cache-refresh")
+        self.refresh_executor.submit(self.refresh, key, fetch)
+
+    def refresh(self, key, fetch):
+        try:
+            self.store(key, fetch())
+            self.count("refreshes")
+        except Exception:
+            # The stale entry keeps being served until it expires, and the next stale hit retries the refresh.
+            self.count("refresh_errors")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class SingleFlight:
+    # Coalesces concurrent calls for the same key within this process. The first caller runs fetch, and callers that
+    # arrive while it's running wait for it and share its result (or exception) instead of making their own call.
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "coalesced": 0}
+
+    def do(self, key, fetch):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+                self.counters["calls"] += 1
+            else:
+                self.counters["coalesced"] += 1
+        if not leader:
+            return call.result()
+        try:
+            result = fetch()
+        except BaseException as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
@@ -0,0 +1,214 @@
+# Deal watch: re-prices a list of tracked routes in the background and keeps their fares in a SQLite file, so that
+# searches for a tracked route can be answered straight away, and so that price drops can be spotted.
+#
+# The routes are read from the JSON file at DEAL_WATCH_ROUTES, eg:
+#   [{"from": "Toronto", "to": "London", "flight_type": "round", "nights": 7, "days_ahead": 14, "window_days": 30},
+#    {"from": "YYZ", "to": "Vancouver", "days_ahead": 1, "window_days": 14, "adults": 2, "currency": "USD"}]
+# Every departure date from days_ahead to days_ahead + window_days - 1 days from today is priced, returning nights
+# days later for round trips. Passengers default to 1 adult and the currency to CAD, like the search form.
+#
+# Run the watcher with "python deal_watch.py" (or "python deal_watch.py --once" for a single pass), or have gunicorn
+# start it with DEAL_WATCH_IN_GUNICORN=1 (see gunicorn.conf.py). The web workers only read the DEAL_WATCH_DB file.
+from cache import SQLiteConnections
+from flight_search import FlightSearch, search_single_call, search_parameters
+from metrics import metrics
+from rate_limiter import RateLimitExceeded
+from datetime import date, datetime, timedelta
+import threading
+import logging
+import json
+import time
+import os
+
+# The deal watch is off unless DEAL_WATCH_DB is set to the path of its SQLite file.
+DEAL_WATCH_DB = os.environ.get("DEAL_WATCH_DB")
+DEAL_WATCH_ROUTES = os.environ.get("DEAL_WATCH_ROUTES", "tracked_routes.json")
+# Seconds between passes over the tracked routes.
+DEAL_WATCH_INTERVAL = int(os.environ.get("DEAL_WATCH_INTERVAL", 30 * 60))
+# Fares older than this aren't served to searches. The default allows for one missed pass.
+DEAL_WATCH_MAX_AGE = int(os.environ.get("DEAL_WATCH_MAX_AGE", 2 * DEAL_WATCH_INTERVAL))
+# A fare that's at least this much cheaper (as a fraction) than the last price seen for the same dates is a price drop.
+DEAL_WATCH_DROP_THRESHOLD = float(os.environ.get("DEAL_WATCH_DROP_THRESHOLD", 0.05))
+
+logger = logging.getLogger("deal_watch")
+
+
+def route_key(parameters):
+    # Identifies a route by its Tequila search parameters, eg: "YYZ-LHR:round:1-0-0:CAD". The form gives the passenger
+    # counts as strings, so they're read as ints.
+    passengers = "-".join(str(int(parameters[field])) for field in ("adults", "children", "infants"))
+    return f'{parameters["fly_from"]}-{parameters["fly_to"]}:{parameters["flight_type"]}:{passengers}:' \
+           f'{parameters["curr"]}'
+
+
+def search_dates(parameters):
+    # The departure and return dates of a search as "YYYY-MM-DD" strings, with "" as the return date of one-way trips.
+    depart_date = datetime.strptime(parameters["date_from"], "%d/%m/%Y").date().isoformat()
+    return_date = ""
+    if parameters["flight_type"] == "round":
+        return_date = datetime.strptime(parameters["return_from"], "%d/%m/%Y").date().isoformat()
+    return depart_date, return_date
+
+
+class DealWatchStore:
+    # The fares found by the deal watch. latest_fares holds the most recent result for each route and dates, which is
+    # what searches are answered with, price_history holds every price seen and price_drops the drops found.
+    def __init__(self, path):
+        self.path = path
+        self.connections = SQLiteConnections(path, [
+            "CREATE TABLE IF NOT EXISTS latest_fares (route TEXT, depart_date TEXT, return_date TEXT, checked_at REAL, "
+            "most_direct TEXT, cheapest TEXT, PRIMARY KEY (route, depart_date, return_date))",
+            "CREATE TABLE IF NOT EXISTS price_history (route TEXT, depart_date TEXT, return_date TEXT, "
+            "checked_at REAL, price REAL, stopovers INTEGER)",
+            "CREATE INDEX IF NOT EXISTS price_history_route_date "
+            "ON price_history (route, depart_date, return_date, checked_at)",
+            "CREATE TABLE IF NOT EXISTS price_drops (route TEXT, depart_date TEXT, return_date TEXT, "
+            "detected_at REAL, old_price REAL, new_price REAL)",
+        ])
+
+    def latest_fares(self, parameters, max_age=DEAL_WATCH_MAX_AGE):
+        # Returns (most_direct_flight, cheapest_flight) for a search, as the dicts flight_info.html reads, or None if
+        # the route and dates aren't tracked or their fares are too old. Both are empty dicts when the last pass
+        # found no flights.
+        depart_date, return_date = search_dates(parameters)
+        row = self.connections.get().execute(
+            "SELECT most_direct, cheapest FROM latest_fares WHERE route = ? AND depart_date = ? AND return_date = ? "
+            "AND checked_at > ?", (route_key(parameters), depart_date, return_date, time.time() - max_age)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def record(self, parameters, most_direct_flight, cheapest_flight):
+        # Stores the result of pricing one route and dates. Returns (old_price, new_price) if the price dropped by
+        # DEAL_WATCH_DROP_THRESHOLD or more since it was last seen, otherwise None.
+        route = route_key(parameters)
+        depart_date, return_date = search_dates(parameters)
+        now = time.time()
+        most_direct = most_direct_flight.as_dict() if most_direct_flight else {}
+        cheapest = cheapest_flight.as_dict() if cheapest_flight else {}
+        connection = self.connections.get()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("INSERT OR REPLACE INTO latest_fares VALUES (?, ?, ?, ?, ?, ?)",
+                               (route, depart_date, return_date, now, json.dumps(most_direct), json.dumps(cheapest)))
+            price_drop = None
+            if cheapest_flight:
+                previous = connection.execute(
+                    "SELECT price FROM price_history WHERE route = ? AND depart_date = ? AND return_date = ? "
+                    "ORDER BY checked_at DESC LIMIT 1", (route, depart_date, return_date)).fetchone()
+                new_price = cheapest_flight.price
+                connection.execute("INSERT INTO price_history VALUES (?, ?, ?, ?, ?, ?)",
+                                   (route, depart_date, return_date, now, new_price, cheapest_flight.stopovers()))
+                if previous is not None and new_price <= previous[0] * (1 - DEAL_WATCH_DROP_THRESHOLD):
+                    price_drop = (previous[0], new_price)
+                    connection.execute("INSERT INTO price_drops VALUES (?, ?, ?, ?, ?, ?)",
+                                       (route, depart_date, return_date, now, previous[0], new_price))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return price_drop
+
+    def price_drops(self, since=0):
+        # The price drops found since the given time, newest first, as dicts.
+        rows = self.connections.get().execute(
+            "SELECT route, depart_date, return_date, detected_at, old_price, new_price FROM price_drops "
+            "WHERE detected_at >= ? ORDER BY detected_at DESC", (since,)).fetchall()
+        fields = ("route", "depart_date", "return_date", "detected_at", "old_price", "new_price")
+        return [dict(zip(fields, row)) for row in rows]
+
+    def purge(self, before):
+        # Drops the fares for departure dates before the given "YYYY-MM-DD" date, which can no longer be searched.
+        self.connections.get().execute("DELETE FROM latest_fares WHERE depart_date < ?", (before,))
+
+
+def load_routes(path):
+    with open(path) as routes_file:
+        routes = json.load(routes_file)
+    for route in routes:
+        route.setdefault("flight_type", "round" if "nights" in route else "oneway")
+        route.setdefault("days_ahead", 1)
+        route.setdefault("window_days", 14)
+        route.setdefault("adults", 1)
+        route.setdefault("children", 0)
+        route.setdefault("infants", 0)
+        route.setdefault("currency", "CAD")
+        if route["flight_type"] == "round" and "nights" not in route:
+            raise ValueError(f"Round trip route {route['from']} to {route['to']} needs a number of \"nights\".")
+    return routes
+
+
+class DealWatcher:
+    # Prices every date of every tracked route, one date at a time, each with a single-call search (so the fares
+    # match what trip_search would find). The calls go through the same rate limiter as the web workers' searches.
+    def __init__(self, routes, store):
+        self.routes = routes
+        self.store = store
+
+    def price_route(self, route, today=None):
+        today = today or date.today()
+        flight_search = FlightSearch()
+        try:
+            departure_city, departure_city_iata = flight_search.city_iata_search(route["from"])
+            destination_city, destination_city_iata = flight_search.city_iata_search(route["to"])
+        except KeyError:
+            logger.warning("Skipping route %s to %s: city not found", route["from"], route["to"])
+            return 0
+        priced = 0
+        for day in range(route["days_ahead"], route["days_ahead"] + route["window_days"]):
+            date_from = today + timedelta(days=day)
+            search = dict(route, date_from=date_from, date_to=None)
+            if route["flight_type"] == "round":
+                search["date_to"] = date_from + timedelta(days=route["nights"])
+            parameters = search_parameters(search, departure_city_iata, destination_city_iata)
+            try:
+                most_direct_flight, cheapest_flight, flights_by_stopovers = search_single_call(parameters,
+                                                                                               destination_city)
+            except (KeyError, RateLimitExceeded):
+                # An API error or a busy API; this date is priced again on the next pass.
+                logger.warning("Couldn't price %s on %s", route_key(parameters), date_from)
+                continue
+            price_drop = self.store.record(parameters, most_direct_flight, cheapest_flight)
+            priced += 1
+            if price_drop:
+                metrics.increment("deal_watch_price_drops_total")
+                logger.info("Price drop on %s departing %s: %s -> %s %s", route_key(parameters), date_from,
+                            price_drop[0], price_drop[1], route["currency"])
+        return priced
+
+    def run_once(self):
+        today = date.today()
+        self.store.purge(today.isoformat())
+        for route in self.routes:
+            try:
+                self.price_route(route, today)
+            except Exception:
+                logger.exception("Pricing route %s to %s failed", route["from"], route["to"])
+
+    def run_forever(self, interval=DEAL_WATCH_INTERVAL, stop=None):
+        # Runs a pass every interval seconds until stop (a threading.Event) is set.
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            started = time.monotonic()
+            self.run_once()
+            logger.info("Priced %s tracked routes in %.1fs", len(self.routes), time.monotonic() - started)
+            stop.wait(max(interval - (time.monotonic() - started), 0))
+
+
+# The store read by trip_search, or None when the deal watch is off.
+deal_watch_store = DealWatchStore(DEAL_WATCH_DB) if DEAL_WATCH_DB else None
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Re-price the tracked routes in DEAL_WATCH_ROUTES.")
+    parser.add_argument("--once", action="store_true", help="price every route once and exit")
+    args = parser.parse_args()
+    if deal_watch_store is None:
+        parser.error("set DEAL_WATCH_DB to the path of the deal watch's SQLite file")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    watcher = DealWatcher(load_routes(DEAL_WATCH_ROUTES), deal_watch_store)
+    if args.once:
+        watcher.run_once()
+    else:
+        watcher.run_forever()
@@ -1,33 +1,227 @@
-import requests
-from datetime import datetime
+from tequila_client import TequilaClient, SearchCancelled
+from cache import LRUCache, SQLiteCache, TieredCache, StaleWhileRevalidateCache, SingleFlight, MISSING
+from rate_limiter import TokenBucket, SQLiteTokenBucket
+from itinerary import Itinerary, trim_itinerary
+from metrics import metrics, run_in_context
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import threading
+import hashlib
+import json
 import os
 
 TEQUILA_API_KEY = os.environ['TEQUILA_API_KEY']
-TEQUILA_URL = "https://tequila-api.kiwi.com"
+TEQUILA_URL = os.environ.get("TEQUILA_URL", "https://tequila-api.kiwi.com")
 
+# The highest max_sector_stopovers value we search. Every tier from 0 up to this value is searched.
+MAX_STOPOVERS = 5
+# Threads shared by every search in this worker process to fan out the stopover tiers. The default lets a single
+# user search run all of its tiers at once.
+SEARCH_THREADS = int(os.environ.get("SEARCH_THREADS", MAX_STOPOVERS + 1))
+
+# In single-call mode we ask for up to SINGLE_CALL_LIMIT itineraries, so that the fewest-stops itineraries are still
+# in the response when there are many cheaper itineraries with more stops. SINGLE_CALL_TOP_N itineraries are kept for
+# each number of stopovers.
+SINGLE_CALL_LIMIT = int(os.environ.get("SINGLE_CALL_LIMIT", 500))
+SINGLE_CALL_TOP_N = int(os.environ.get("SINGLE_CALL_TOP_N", 3))
+# A flexible-date search covers several days at once, so it asks for up to CALENDAR_LIMIT itineraries (the API's
+# maximum is 1000).
+CALENDAR_LIMIT = int(os.environ.get("CALENDAR_LIMIT", 1000))
+
+_search_executor = None
+_search_executor_lock = threading.Lock()
+
+# Every call to the Tequila API first takes a token from a rate limiter, which lets TEQUILA_RATE_LIMIT calls a second
+# through, with bursts of up to TEQUILA_RATE_BURST calls. Calls over the limit wait their turn, and a call that would
+# wait more than TEQUILA_RATE_LIMIT_MAX_WAIT seconds raises RateLimitExceeded instead. TEQUILA_RATE_LIMIT_BACKEND picks
+# where the limiter is kept: "sqlite" (the TEQUILA_RATE_LIMIT_DB file, so the limit covers every worker on the
+# machine), "memory" (a separate limit for each worker) or "none" to turn it off.
+TEQUILA_RATE_LIMIT_BACKEND = os.environ.get("TEQUILA_RATE_LIMIT_BACKEND", "sqlite")
+TEQUILA_RATE_LIMIT = float(os.environ.get("TEQUILA_RATE_LIMIT", 10))
+TEQUILA_RATE_BURST = float(os.environ.get("TEQUILA_RATE_BURST", 20))
+TEQUILA_RATE_LIMIT_MAX_WAIT = float(os.environ.get("TEQUILA_RATE_LIMIT_MAX_WAIT", 10))
+TEQUILA_RATE_LIMIT_DB = os.environ.get("TEQUILA_RATE_LIMIT_DB", "tequila_rate_limit.db")
+
+
+def build_rate_limiter(backend):
+    if backend == "sqlite":
+        return SQLiteTokenBucket(TEQUILA_RATE_LIMIT_DB, "tequila", TEQUILA_RATE_LIMIT, TEQUILA_RATE_BURST,
+                                 TEQUILA_RATE_LIMIT_MAX_WAIT)
+    elif backend == "memory":
+        return TokenBucket(TEQUILA_RATE_LIMIT, TEQUILA_RATE_BURST, TEQUILA_RATE_LIMIT_MAX_WAIT)
+    elif backend == "none":
+        return None
+    raise ValueError(f"Unknown TEQUILA_RATE_LIMIT_BACKEND: {backend}")
+
+
+rate_limiter = build_rate_limiter(TEQUILA_RATE_LIMIT_BACKEND)
+
+# Every call to the Tequila API goes through this client, which keeps connections to the API open between searches.
+# The pool is sized so each of the search threads (plus the cache's background refreshes) can hold a connection.
+# Requests answered with 429 or 5xx are retried TEQUILA_RETRIES times with exponential backoff.
+tequila_client = TequilaClient(
+    TEQUILA_URL,
+    TEQUILA_API_KEY,
+    pool_size=int(os.environ.get("TEQUILA_POOL_SIZE", SEARCH_THREADS + 2)),
+    connect_timeout=float(os.environ.get("TEQUILA_CONNECT_TIMEOUT", 3.05)),
+    read_timeout=float(os.environ.get("TEQUILA_READ_TIMEOUT", 30)),
+    retries=int(os.environ.get("TEQUILA_RETRIES", 2)),
+    backoff_factor=float(os.environ.get("TEQUILA_BACKOFF", 0.5)),
+    rate_limiter=rate_limiter,
+)
+
+# When several searches in this worker need the same API call at the same time (eg: a popular route, before the
+# result is cached), only one call is made and every search waits for its response.
+search_requests = SingleFlight()
+city_lookups = SingleFlight()
+
+# City/airport lookups rarely change, so the results of city_iata_search are cached. Cities the API can't find are
+# cached too (for a shorter time), so repeated typos don't go back to the API. Setting IATA_CACHE_DB to a file path
+# adds a SQLite cache shared by every gunicorn worker on the machine, on top of each worker's in-memory cache.
+IATA_CACHE_TTL = int(os.environ.get("IATA_CACHE_TTL", 7 * 24 * 60 * 60))
+IATA_NEGATIVE_CACHE_TTL = int(os.environ.get("IATA_NEGATIVE_CACHE_TTL", 60 * 60))
+IATA_CACHE_SIZE = int(os.environ.get("IATA_CACHE_SIZE", 2048))
+IATA_CACHE_DB = os.environ.get("IATA_CACHE_DB")
+
+iata_cache = TieredCache(LRUCache(IATA_CACHE_SIZE, IATA_CACHE_TTL),
+                         SQLiteCache(IATA_CACHE_DB, "iata_cache", IATA_CACHE_TTL) if IATA_CACHE_DB else None)
+
+
+# Results of /v2/search are cached for SEARCH_CACHE_TTL seconds, keyed on the search parameters. After that they're
+# served stale for up to SEARCH_CACHE_STALE_TTL more seconds while a fresh copy is fetched in the background.
+# SEARCH_CACHE_BACKEND picks where they're kept: "memory" (per worker), "sqlite" (the SEARCH_CACHE_DB file, shared by
+# every worker on the machine) or "none" to turn the cache off. API responses can be large, so the cache sizes are
+# kept small.
+SEARCH_CACHE_BACKEND = os.environ.get("SEARCH_CACHE_BACKEND", "memory")
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 5 * 60))
+SEARCH_CACHE_STALE_TTL = int(os.environ.get("SEARCH_CACHE_STALE_TTL", 15 * 60))
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 64))
+SEARCH_CACHE_DB = os.environ.get("SEARCH_CACHE_DB", "search_cache.db")
+
+
+def build_search_cache(backend):
+    if backend == "memory":
+        storage = LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL + SEARCH_CACHE_STALE_TTL)
+    elif backend == "sqlite":
+        storage = SQLiteCache(SEARCH_CACHE_DB, "search_cache", SEARCH_CACHE_TTL + SEARCH_CACHE_STALE_TTL,
+                              max_rows=SEARCH_CACHE_SIZE * 16)
+    elif backend == "none":
+        return None
+    else:
+        raise ValueError(f"Unknown SEARCH_CACHE_BACKEND: {backend}")
+    # Responses without "data" are API errors (eg: rate limiting), and shouldn't be served to later searches.
+    return StaleWhileRevalidateCache(storage, SEARCH_CACHE_TTL, SEARCH_CACHE_STALE_TTL,
+                                     should_cache=lambda flights: "data" in flights)
 
-class FlightSearch:
-    def __init__(self):
-        self.price = 0
-        self.city_from = []
-        self.city_to = []
-        self.depart_date = []
-        self.depart_time = []
-        self.return_date = []
-        self.return_time = []
-        self.flight_time = []
-        self.layover_time = []
-        self.total_travel_time = []
-        self.airline = []
-        self.flight_num = []
-        self.depart_return_split_count = 0
 
+search_cache = build_search_cache(SEARCH_CACHE_BACKEND)
 
+
+def check_search(search):
+    # Checks the dates and passengers of a search, the same way for the search form and the batch API. search is a dict
+    # with date_from and date_to (None for one-way trips) as dates, and the adults, children and infants counts. Raises
+    # ValueError with a message for the user if the search can't be run.
+    # Searches can start from tomorrow, since users will rarely search for flights on the same day.
+    tomorrow = datetime.today().date() + timedelta(days=1)
+    if search["date_from"] < tomorrow:
+        raise ValueError("Your travel dates cannot be before tomorrow's date.")
+    if search["date_to"] and search["date_from"] > search["date_to"]:
+        raise ValueError("You may not have a return date earlier than your departure date.")
+    # The Tequila API will only allow searches to a max of 9 passengers.
+    if int(search["adults"]) + int(search["children"]) + int(search["infants"]) > 9:
+        raise ValueError("You may only search for flights with a total of 9 passengers.")
+
+
+def search_parameters(search, departure_iata, destination_iata):
+    # The Tequila API parameters for a search (a dict like check_search's, plus its flight_type, "oneway" or "round",
+    # and currency). The API searches a range of departure dates (date_from to date_to), but we only want flights
+    # leaving on the given date, so both are set to it, and likewise return_from and return_to for round trips. Round
+    # trips also need a range of nights at the destination: we assume the traveller wants to stay the nights between
+    # their dates, and allow 2 nights either side, since cheaper overseas flights often need an overnight stopover.
+    # max_sector_stopovers is added per search by the stopover searches.
+    date_from_string = search["date_from"].strftime("%d/%m/%Y")
+    parameters = {
+        "fly_from": departure_iata,
+        "fly_to": destination_iata,
+        "date_from": date_from_string,
+        "date_to": date_from_string,
+        "adults": search["adults"],
+        "children": search["children"],
+        "infants": search["infants"],
+        "flight_type": search["flight_type"],
+        "curr": search["currency"]
+    }
+    if search["flight_type"] == "round":
+        nights_stay = (search["date_to"] - search["date_from"]).days
+        date_to_string = search["date_to"].strftime("%d/%m/%Y")
+        parameters["return_from"] = date_to_string
+        parameters["return_to"] = date_to_string
+        parameters["nights_in_dst_from"] = (nights_stay - 2)
+        parameters["nights_in_dst_to"] = (nights_stay + 2)
+    return parameters
+
+
+def search_cache_key(parameters):
+    # The form gives us passenger counts as strings while other callers may use ints, so every value is compared as
+    # a string, and the key order doesn't matter.
+    canonical = json.dumps({key: str(value) for key, value in parameters.items()}, sort_keys=True)
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def request_flights(parameters, cancelled=None):
+    # cancelled is an optional threading.Event, set once the search no longer needs these flights (see
+    # TequilaClient.get). When an identical call this one was waiting on is cancelled by its own search, this search
+    # makes the call itself.
+    key = search_cache_key(parameters)
+    while True:
+        try:
+            return search_requests.do(key, lambda: tequila_client.get("/v2/search", params=parameters,
+                                                                      cancelled=cancelled).json())
+        except SearchCancelled:
+            if cancelled is not None and cancelled.is_set():
+                raise
+
+
+def fetch_flights(parameters, cancelled=None, reduce=None, reduce_key=None):
+    # reduce, when given, cuts a response down to what the caller reads before it's cached (eg: the few itineraries
+    # a search shows, out of the hundreds it asked for), so that large responses don't fill the cache. The reduced
+    # response must still be a JSON object with a "data" list. reduce_key names the reduction in the cache key, since
+    # the same call can be reduced in different ways. API errors (responses without "data") are kept as they are.
+    if search_cache is None:
+        return request_flights(parameters, cancelled)
+    # The parameters are copied since a background refresh may run after the caller has changed its dict. Background
+    # refreshes aren't tied to the search that started them, so they're never cancelled.
+    parameters = dict(parameters)
+    cache_key = search_cache_key(parameters)
+    if reduce is not None:
+        cache_key = f"{cache_key}:{reduce_key}"
+
+    def fetch(cancelled=None):
+        response = request_flights(parameters, cancelled)
+        if reduce is None or "data" not in response:
+            return response
+        with metrics.phase("parse"):
+            return reduce(response)
+
+    return search_cache.get_or_fetch(cache_key, lambda: fetch(cancelled), refresh_fetch=fetch)
+
+
+def normalize_city(city):
+    # "  Toronto ", "toronto" and "TORONTO" are all the same lookup.
+    return " ".join(city.split()).lower()
+
+
+class FlightSearch:
     def city_iata_search(self, city):
-        location_endpoint = f"{TEQUILA_URL}/locations/query"
-        headers = {
-            "apikey": TEQUILA_API_KEY
-        }
+        # A KeyError is raised when the city can't be found, either from the cache or from the API response.
+        cache_key = normalize_city(city)
+        cached = iata_cache.get(cache_key)
+        if cached is not MISSING:
+            if cached is None:
+                raise KeyError(city)
+            return tuple(cached)
+
+        city = " ".join(city.split())
         if len(city) != 3:
             parameters = {
                 "term": city,
@@ -37,111 +231,255 @@ class FlightSearch:
             parameters = {
                 "term": city,
             }
-        response = requests.get(url=location_endpoint, headers=headers, params=parameters)
-        results = response.json()["locations"]
+        response = city_lookups.do(cache_key,
+                                   lambda: tequila_client.get("/locations/query", params=parameters).json())
+        # A response without "locations" is an API error rather than an unknown city, so it isn't cached.
+        results = response["locations"]
 
-        if len(city) == 3:
-            city_name = results[0]["city"]["name"]
-            iata_code = results[0]["code"]
-        else:
-            city_name = results[0]["name"]
-            iata_code = results[0]["code"]
+        try:
+            if len(city) == 3:
+                city_name = results[0]["city"]["name"]
+                iata_code = results[0]["code"]
+            else:
+                city_name = results[0]["name"]
+                iata_code = results[0]["code"]
+        except (IndexError, KeyError):
+            iata_cache.set(cache_key, None, ttl=IATA_NEGATIVE_CACHE_TTL)
+            raise KeyError(city)
+        iata_cache.set(cache_key, [city_name, iata_code])
         return city_name, iata_code
 
-    def flight_search(self, flight_parameters, destination_city):
-        headers = {
-            "apikey": TEQUILA_API_KEY
-        }
-        parameters = flight_parameters
-        response = requests.get(url=f"{TEQUILA_URL}/v2/search", headers=headers, params=parameters)
-        flight = response.json()
-
-        depart_date_and_time = []
-        return_date_and_time = []
-        departure_time_utc = []
-        arrival_time_utc = []
-
-        for x in range(0, len(flight["data"][0]["route"])):
-            self.city_from.append(
-                [flight["data"][0]["route"][x]["cityFrom"], flight["data"][0]["route"][x]["cityCodeFrom"]])
-            self.city_to.append([flight["data"][0]["route"][x]["cityTo"], flight["data"][0]["route"][x]["cityCodeTo"]])
-            depart_date_and_time.append(flight["data"][0]["route"][x]["local_departure"])
-            return_date_and_time.append(flight["data"][0]["route"][x]["local_arrival"])
-            departure_time_utc.append(flight["data"][0]["route"][x]["utc_departure"])
-            arrival_time_utc.append(flight["data"][0]["route"][x]["utc_arrival"])
-            self.flight_time.append(self.time_calc(flight["data"][0]["route"][x]["utc_departure"],
-                                                   flight["data"][0]["route"][x]["utc_arrival"]))
-            self.airline.append(flight["data"][0]["route"][x]["airline"])
-            self.flight_num.append(flight["data"][0]["route"][x]["flight_no"])
-
-        if flight_parameters["flight_type"] == "round":
-            for count in range(0, len(self.city_from)):
-                if self.city_from[count][0] == destination_city:
-                    self.depart_return_split_count = count
+    def flight_search(self, flight_parameters, destination_city, cancelled=None):
+        flight = fetch_flights(flight_parameters, cancelled)
+        with metrics.phase("parse"):
+            return self.parse_itinerary(flight["data"][0], flight_parameters, destination_city)
+
+    def parse_itinerary(self, itinerary, flight_parameters, destination_city):
+        # Turns one itinerary from the "data" list of a /v2/search response into an Itinerary, which flight_info.html
+        # reads like a dict.
+        return Itinerary(itinerary, flight_parameters, destination_city)
+
+
+def get_search_executor():
+    # The pool is created lazily so that it's built inside each gunicorn worker rather than in a parent process
+    # that later forks.
+    global _search_executor
+    with _search_executor_lock:
+        if _search_executor is None:
+            _search_executor = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="tequila-search")
+    return _search_executor
+
+
+def search_stopover_tier(parameters, destination_city, stopovers, cancelled=None):
+    # An IndexError means the API returned no flights for this number of stopovers. SearchCancelled means the search
+    # was settled by other tiers before this one sent its call, so its result isn't needed.
+    tier_parameters = dict(parameters, max_sector_stopovers=stopovers)
+    try:
+        return FlightSearch().flight_search(tier_parameters, destination_city, cancelled)
+    except (IndexError, SearchCancelled):
+        return None
+
+
+def reduce_stopover_tiers(tier_results):
+    # tier_results maps the stopovers value to the flight found for that tier (or None). The most direct flight is
+    # the flight from the lowest tier that found anything, and the cheapest flight is the lowest price across all
+    # the tiers, with ties going to the tier with fewer stopovers.
+    most_direct_flight = {}
+    cheapest_flight = {}
+    for stopovers in sorted(tier_results):
+        flight = tier_results[stopovers]
+        if not flight or not flight.price:
+            continue
+        if not most_direct_flight:
+            most_direct_flight = flight
+        if not cheapest_flight or flight.price < cheapest_flight.price:
+            cheapest_flight = flight
+    return most_direct_flight, cheapest_flight
+
+
+def most_direct_settled(tier_results, max_stopovers):
+    # The most direct flight is settled once some tier found a flight and every tier below it has come back empty.
+    for stopovers in range(0, max_stopovers + 1):
+        if stopovers not in tier_results:
+            return False
+        if tier_results[stopovers]:
+            return True
+    return False
+
+
+def stopover_tiers_settled(tier_results, max_stopovers):
+    # The highest tier allows every number of stopovers the lower tiers do, so its first (cheapest) result is the
+    # cheapest flight overall. Once it's back, the search is settled when the most direct flight is, or when every
+    # tier has come back empty.
+    if max_stopovers not in tier_results:
+        return False
+    return most_direct_settled(tier_results, max_stopovers) or len(tier_results) == max_stopovers + 1
+
+
+def iter_stopover_tiers(parameters, destination_city, max_stopovers=MAX_STOPOVERS):
+    # Dispatches every tier at once and yields tier_results (the stopovers value of each tier that's back, mapped to
+    # its flight or None) each time a tier comes back, until the answer is settled. Once it is (or the caller stops
+    # early), the remaining tiers are cancelled: tiers still waiting for a thread in the pool never start, and tiers
+    # that haven't sent their call yet (eg: because the rate limiter is making them wait) give up without sending it,
+    # so they don't hold up the searches behind them. Calls that have already been sent can't be stopped, so they
+    # finish in the background and their results are ignored.
+    executor = get_search_executor()
+    cancelled = threading.Event()
+    # Each tier runs with a copy of the request's context so its timings are recorded against this request. The highest
+    # tier is needed to settle any search, so it's sent first, then the rest from the most direct up, so that when the
+    # rate limiter spaces the calls out the ones most likely to settle the search go out before the others.
+    futures = {}
+    for stopovers in [max_stopovers] + list(range(0, max_stopovers)):
+        future = executor.submit(run_in_context(search_stopover_tier), parameters, destination_city, stopovers,
+                                 cancelled)
+        futures[future] = stopovers
+    tier_results = {}
+    try:
+        for future in as_completed(futures):
+            tier_results[futures[future]] = future.result()
+            yield tier_results
+            if stopover_tiers_settled(tier_results, max_stopovers):
+                break
+    finally:
+        cancelled.set()
+        for future in futures:
+            future.cancel()
+
+
+def search_stopover_tiers(parameters, destination_city, max_stopovers=MAX_STOPOVERS, concurrent=True):
+    # Searches every max_sector_stopovers value from 0 to max_stopovers and returns (most_direct_flight,
+    # cheapest_flight), either of which is an empty dict when no flight was found.
+    if not concurrent:
+        tier_results = {}
+        for stopovers in range(0, max_stopovers + 1):
+            tier_results[stopovers] = search_stopover_tier(parameters, destination_city, stopovers)
+        return reduce_stopover_tiers(tier_results)
+
+    # All the tiers are dispatched at once, so the search takes roughly as long as the slowest single call.
+    tier_results = {}
+    for tier_results in iter_stopover_tiers(parameters, destination_city, max_stopovers):
+        pass
+    return reduce_stopover_tiers(tier_results)
+
+
+def search_stopover_tiers_progressive(parameters, destination_city, max_stopovers=MAX_STOPOVERS):
+    # The concurrent search_stopover_tiers, reporting the flights as they're found rather than all at the end. Yields
+    # ("most_direct", flight) as soon as the most direct flight is settled, ("cheapest", flight) each time a cheaper
+    # flight comes back, and finally ("done", (most_direct_flight, cheapest_flight)) with the same flights
+    # search_stopover_tiers would return.
+    most_direct_sent = False
+    cheapest_sent = None
+    most_direct_flight, cheapest_flight = {}, {}
+    for tier_results in iter_stopover_tiers(parameters, destination_city, max_stopovers):
+        most_direct_flight, cheapest_flight = reduce_stopover_tiers(tier_results)
+        if not most_direct_sent and most_direct_settled(tier_results, max_stopovers):
+            most_direct_sent = True
+            yield "most_direct", most_direct_flight
+        if cheapest_flight and cheapest_flight is not cheapest_sent:
+            cheapest_sent = cheapest_flight
+            yield "cheapest", cheapest_flight
+    yield "done", (most_direct_flight, cheapest_flight)
+
+
+def pick_single_call_flights(itineraries, call_parameters, destination_city, top_n):
+    # The single pass of search_single_call over the itineraries of a response. Returns (most_direct_flight,
+    # cheapest_flight, flights_by_stopovers, sources), with the flights as Itinerary objects (None when there are
+    # none) and sources mapping id(flight) to (its position in itineraries, the itinerary it was read from).
+    cheapest_flight = None
+    most_direct_flight = None
+    most_direct_stopovers = None
+    flights_by_stopovers = {}
+    sources = {}
+    for index, data in enumerate(itineraries):
+        if not data["price"]:
+            continue
+        flight = Itinerary(data, call_parameters, destination_city)
+        sources[id(flight)] = (index, data)
+        price = flight.price
+        stopovers = flight.stopovers()
+        if cheapest_flight is None or price < cheapest_flight.price:
+            cheapest_flight = flight
+        if most_direct_flight is None or stopovers < most_direct_stopovers or \
+                (stopovers == most_direct_stopovers and price < most_direct_flight.price):
+            most_direct_flight = flight
+            most_direct_stopovers = stopovers
+        # Each list is kept sorted by price and cut down to top_n, so it's never sorted with more than top_n + 1
+        # entries.
+        top = flights_by_stopovers.setdefault(stopovers, [])
+        if len(top) < top_n or price < top[-1].price:
+            top.append(flight)
+            top.sort(key=lambda entry: entry.price)
+            del top[top_n:]
+    return most_direct_flight, cheapest_flight, flights_by_stopovers, sources
+
+
+def search_single_call(parameters, destination_city, max_stopovers=MAX_STOPOVERS, top_n=SINGLE_CALL_TOP_N):
+    # One /v2/search call allowing max_stopovers, instead of one call per stopover tier. The itineraries returned are
+    # read in a single pass to find the cheapest itinerary, the most direct itinerary (fewest stopovers, then
+    # cheapest, which is what the lowest successful tier returns) and the top_n cheapest itineraries for each
+    # number of stopovers.
+    # Only the itineraries picked (trimmed, and in their original order, so that reading them again picks the same
+    # ones) are cached, rather than the up to SINGLE_CALL_LIMIT itineraries of the response.
+    # Returns (most_direct_flight, cheapest_flight, flights_by_stopovers), with the flights as Itinerary objects.
+    call_parameters = dict(parameters, max_sector_stopovers=max_stopovers, limit=SINGLE_CALL_LIMIT)
+
+    def reduce(response):
+        most_direct_flight, cheapest_flight, flights_by_stopovers, sources = pick_single_call_flights(
+            response["data"], call_parameters, destination_city, top_n)
+        picked = {id(flight) for flights in flights_by_stopovers.values() for flight in flights}
+        picked.update(id(flight) for flight in (most_direct_flight, cheapest_flight) if flight is not None)
+        return {"data": [trim_itinerary(data) for index, data in sorted((sources[key] for key in picked),
+                                                                        key=lambda source: source[0])]}
+
+    response = fetch_flights(call_parameters, reduce=reduce, reduce_key=f"single_call:{top_n}:{destination_city}")
+    with metrics.phase("parse"):
+        most_direct_flight, cheapest_flight, flights_by_stopovers, sources = pick_single_call_flights(
+            response["data"], call_parameters, destination_city, top_n)
+
+    if cheapest_flight is None:
+        return {}, {}, {}
+    return most_direct_flight, cheapest_flight, dict(sorted(flights_by_stopovers.items()))
+
+
+def cheapest_by_date(itineraries, round_trip, destination_city):
+    # Buckets the itineraries of a /v2/search response by departure date (and return date), keeping the cheapest
+    # itinerary of each. Returns a dict of (depart_date, return_date) to the itinerary.
+    cheapest_itineraries = {}
+    for data in itineraries:
+        price = data["price"]
+        if not price:
+            continue
+        route = data["route"]
+        depart_date = route[0]["local_departure"][:10]
+        return_date = None
+        if round_trip:
+            for segment in route:
+                if segment.get("return", segment["cityFrom"] == destination_city):
+                    return_date = segment["local_departure"][:10]
                     break
+        cheapest = cheapest_itineraries.get((depart_date, return_date))
+        if cheapest is None or price < cheapest["price"]:
+            cheapest_itineraries[(depart_date, return_date)] = data
+    return cheapest_itineraries
+
+
+def search_price_calendar(parameters, destination_city, max_stopovers=MAX_STOPOVERS):
+    # One /v2/search call over a range of dates (date_from..date_to, and return_from..return_to for round trips)
+    # instead of one search per day. The itineraries are read in a single pass and bucketed by departure date (and
+    # return date), keeping only the cheapest of each, and only those are parsed. Only those (trimmed) are cached
+    # too, rather than the up to CALENDAR_LIMIT itineraries of the response.
+    # Returns a list of (depart_date, return_date, Itinerary) sorted by date, with the dates as "YYYY-MM-DD" strings.
+    # return_date is None for one-way trips.
+    call_parameters = dict(parameters, max_sector_stopovers=max_stopovers, limit=CALENDAR_LIMIT)
+    round_trip = parameters["flight_type"] == "round"
+
+    def reduce(response):
+        return {"data": [trim_itinerary(data) for data in
+                         cheapest_by_date(response["data"], round_trip, destination_city).values()]}
 
-        self.price = flight["data"][0]["price"]
-        self.depart_date, self.depart_time = self.date_and_time_split(depart_date_and_time)
-        self.return_date, self.return_time = self.date_and_time_split(return_date_and_time)
-
-        if len(depart_date_and_time) > 1:
-            self.layover_time = self.layover_time_calc(departure_time_utc, arrival_time_utc)
-
-        self.total_travel_time = self.total_travel_time_calc(departure_time_utc, arrival_time_utc,
-                                                             self.depart_return_split_count)
-
-        flight_output = {
-            "price": self.price,
-            "city_from": self.city_from,
-            "city_to": self.city_to,
-            "depart_date": self.depart_date,
-            "depart_time": self.depart_time,
-            "return_date": self.return_date,
-            "return_time": self.return_time,
-            "flight_time": self.flight_time,
-            "layover_time": self.layover_time,
-            "total_travel_time": self.total_travel_time,
-            "airline": self.airline,
-            "flight_num": self.flight_num,
-            "currency": flight_parameters["curr"]
-        }
-        if flight_parameters["flight_type"] == "round":
-            flight_output["depart_return_split_count"] = self.depart_return_split_count
-        return flight_output
-
-    def time_calc(self, initial_time, secondary_time):
-        initial_string = initial_time[0:10] + " " + initial_time[11:16]
-        initial_datetime = datetime.strptime(initial_string, '%Y-%m-%d %H:%M')
-
-        secondary_string = secondary_time[0:10] + " " + secondary_time[11:16]
-        secondary_datetime = datetime.strptime(secondary_string, '%Y-%m-%d %H:%M')
-        difference = secondary_datetime - initial_datetime
-        difference = str(difference)
-        difference = difference.split(":")
-        difference_string = difference[0] + "h" + difference[1] + "m"
-        return difference_string
-
-    def total_travel_time_calc(self, departure_time, arrival_time, depart_return_split):
-        total_time_travel = []
-        depart_total_time = self.time_calc(departure_time[0], arrival_time[depart_return_split - 1])
-        return_total_time = self.time_calc(departure_time[depart_return_split], arrival_time[-1])
-        total_time_travel.append(depart_total_time)
-        total_time_travel.append(return_total_time)
-        return total_time_travel
-
-    def layover_time_calc(self, depart_times, arrival_times):
-        layover_times = []
-        for count in range(0, (len(depart_times) - 1)):
-            layover_times.append(self.time_calc(arrival_times[count], depart_times[count+1]))
-        return layover_times
-
-    def date_and_time_split(self, dates_and_times):
-        dates = []
-        times = []
-        for date_time in dates_and_times:
-            date_time_split = date_time.split("T")
-            dates.append(date_time_split[0])
-            time = date_time_split[1].split("Z")[0]
-            hours_mins = time.split(":")
-            times.append(f"{hours_mins[0]}:{hours_mins[1]}")
-        return dates, times
+    response = fetch_flights(call_parameters, reduce=reduce, reduce_key=f"calendar:{destination_city}")
+    with metrics.phase("parse"):
+        cheapest_itineraries = cheapest_by_date(response["data"], round_trip, destination_city)
+        return [(depart_date, return_date, Itinerary(data, call_parameters, destination_city))
+                for (depart_date, return_date), data in sorted(cheapest_itineraries.items(),
+                                                               key=lambda item: (item[0][0], item[0][1] or ""))]
@@ -1,25 +1,35 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, SelectField, DateField
 from wtforms.validators import DataRequired, Length
-from datetime import datetime, timedelta
+from datetime import date, timedelta
+
+# The choices are built once and shared by every form, rather than written out as new lists for each field.
+ADULT_CHOICES = tuple((count, count) for count in range(1, 10))
+PASSENGER_CHOICES = tuple((count, count) for count in range(0, 10))
+FLEXIBLE_DAYS_CHOICES = ((0, "Exact dates"), (3, "Next 3 days"), (7, "Next 7 days"), (14, "Next 14 days"))
+CURRENCY_CHOICES = (("CAD", "CAD"), ("USD", "USD"), ("EUR", "EUR"))
+
+
+# The default dates are worked out each time a form is built, so they stay correct in a worker that runs for days.
+def default_depart():
+    return date.today() + timedelta(days=1)
+
+
+def default_return():
+    return date.today() + timedelta(days=3)
 
-today = datetime.today().date()
-default_depart = today + timedelta(days=1)
-default_return = today + timedelta(days=3)
 
 class FlightSearchForm(FlaskForm):
     departure_city = StringField("Departure City", render_kw={"placeholder": "From where?"},
                                       validators=[DataRequired(), Length(min=3, max=30)])
     destination_city = StringField("Destination City", render_kw={"placeholder": "To where?"},
                                       validators=[DataRequired(), Length(min=3, max=30)])
-    adults = SelectField("Adults", choices=[(1, 1), (2, 2), (3, 3), (4, 4), (5, 5), (6, 6), (7, 7), (8, 8), (9, 9)],
-                           validators=[DataRequired()])
-    children = SelectField("Children", choices=[(0, 0), (1, 1), (2, 2), (3, 3), (4, 4), (5, 5), (6, 6), (7, 7), (8, 8), (9, 9)],
-                           validators=[DataRequired()])
-    infants = SelectField("Infants", choices=[(0, 0), (1, 1), (2, 2), (3, 3), (4, 4), (5, 5), (6, 6), (7, 7), (8, 8), (9, 9)],
-                           validators=[DataRequired()])
+    adults = SelectField("Adults", choices=ADULT_CHOICES, validators=[DataRequired()])
+    children = SelectField("Children", choices=PASSENGER_CHOICES, validators=[DataRequired()])
+    infants = SelectField("Infants", choices=PASSENGER_CHOICES, validators=[DataRequired()])
     date_from = DateField("Depart", validators=[DataRequired()], default=default_depart)
     date_to = DateField("Return", validators=[DataRequired()], default=default_return)
-    currency = SelectField("Currency", choices=[("CAD", "CAD"), ("USD", "USD"), ("EUR", "EUR")],
-                           validators=[DataRequired()])
-    submit = SubmitField("Search Flights")
\ No newline at end of file
+    # Searching a range of days from the departure (and return) date shows the cheapest fare for each day instead.
+    flexible_days = SelectField("Flexible Dates", choices=FLEXIBLE_DAYS_CHOICES, coerce=int, default=0)
+    currency = SelectField("Currency", choices=CURRENCY_CHOICES, validators=[DataRequired()])
+    submit = SubmitField("Search Flights")
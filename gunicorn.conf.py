@@ -0,0 +1,42 @@
+# gunicorn reads this file automatically when started from the project folder (see Procfile).
+import os
+
+# GUNICORN_WORKER_CLASS picks how each worker process serves searches:
+#   "sync" (the default) - one search at a time per worker. A search holds its worker for the whole time it waits on
+#       the Tequila API, so the number of searches in progress is capped at the number of workers.
+#   "gevent" - each worker serves up to GUNICORN_WORKER_CONNECTIONS searches at once. Waiting on the Tequila API
+#       yields to other searches instead of blocking the worker, with no changes to the views.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 200))
+# Workers that go quiet for GUNICORN_TIMEOUT seconds are restarted. The default is gunicorn's own (30).
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+# With PRELOAD_APP=1 the app is imported (and its templates compiled, see main.preload) once in the master process
+# before the workers are forked, so workers start straight away and share that memory.
+preload_app = os.environ.get("PRELOAD_APP", "0") == "1"
+
+if worker_class == "gevent":
+    # Patch the standard library before the app (and requests/urllib3) are imported, so sockets, threads and locks
+    # all cooperate with gevent. The search thread pool then runs its tiers as greenlets, so it can be sized to the
+    # number of searches a worker serves at once rather than to a handful of threads.
+    from gevent import monkey
+    monkey.patch_all()
+    os.environ.setdefault("SEARCH_THREADS", str(worker_connections))
+
+
+deal_watcher = None
+
+
+def when_ready(server):
+    # With DEAL_WATCH_DB and DEAL_WATCH_IN_GUNICORN=1 set, gunicorn starts the deal watch (see deal_watch.py) next to
+    # the workers, so there's a single watcher however many workers are serving searches. It runs as its own process
+    # rather than a thread of the master, since the workers are forked from the master.
+    global deal_watcher
+    if os.environ.get("DEAL_WATCH_DB") and os.environ.get("DEAL_WATCH_IN_GUNICORN") == "1":
+        import subprocess
+        import sys
+        deal_watcher = subprocess.Popen([sys.executable, "deal_watch.py"])
+
+
+def on_exit(server):
+    if deal_watcher is not None:
+        deal_watcher.terminate()
@@ -0,0 +1,166 @@
+from datetime import datetime
+
+EPOCH = datetime(1970, 1, 1)
+# The fields of each segment of a /v2/search itinerary's route that Segment reads. The API sends many more (booking
+# links, bag prices, fare details...), which trim_itinerary drops from itineraries that are kept around.
+SEGMENT_FIELDS = ("cityFrom", "cityCodeFrom", "cityTo", "cityCodeTo", "local_departure", "local_arrival", "dTimeUTC",
+                  "aTimeUTC", "utc_departure", "utc_arrival", "airline", "flight_no", "return")
+
+
+class Segment:
+    # One flight of an itinerary, read from a single entry of the "route" list in a /v2/search response.
+    # departure_ts and arrival_ts are the UTC departure and arrival times in seconds since the epoch, to the minute.
+    __slots__ = ("city_from", "city_code_from", "city_to", "city_code_to", "local_departure", "local_arrival",
+                 "departure_ts", "arrival_ts", "airline", "flight_num", "is_return")
+
+    def __init__(self, segment):
+        self.city_from = segment["cityFrom"]
+        self.city_code_from = segment["cityCodeFrom"]
+        self.city_to = segment["cityTo"]
+        self.city_code_to = segment["cityCodeTo"]
+        self.local_departure = segment["local_departure"]
+        self.local_arrival = segment["local_arrival"]
+        # Older responses also carry the times as integers (dTimeUTC/aTimeUTC), which saves parsing the strings.
+        if "dTimeUTC" in segment and "aTimeUTC" in segment:
+            self.departure_ts = segment["dTimeUTC"] - segment["dTimeUTC"] % 60
+            self.arrival_ts = segment["aTimeUTC"] - segment["aTimeUTC"] % 60
+        else:
+            self.departure_ts = timestamp_seconds(segment["utc_departure"])
+            self.arrival_ts = timestamp_seconds(segment["utc_arrival"])
+        self.airline = segment["airline"]
+        self.flight_num = segment["flight_no"]
+        self.is_return = segment.get("return")
+
+
+class Itinerary:
+    # A flight (one-way or round trip) built from one entry of the "data" list in a /v2/search response, in a single
+    # pass over its route. The dict used by flight_info.html is only built the first time it's needed, so itineraries
+    # that are never shown cost little to parse. Indexing an Itinerary (flight["price"]) reads from that dict.
+    __slots__ = ("price", "currency", "flight_type", "segments", "depart_return_split_count", "_template")
+
+    def __init__(self, itinerary, flight_parameters, destination_city):
+        self.price = itinerary["price"]
+        self.currency = flight_parameters["curr"]
+        self.flight_type = flight_parameters["flight_type"]
+        self.segments = [Segment(segment) for segment in itinerary["route"]]
+        self._template = None
+        # For round trips, depart_return_split_count is the index of the first segment of the return flight, or 0
+        # when it can't be found.
+        self.depart_return_split_count = 0
+        if self.flight_type == "round":
+            split = return_split(self.segments, destination_city)
+            if split is not None:
+                self.depart_return_split_count = split
+
+    def stopovers(self):
+        # The most stops on either the departure or the return flight. This is the max_sector_stopovers value
+        # needed for the API to return this itinerary.
+        if self.flight_type != "round":
+            return len(self.segments) - 1
+        split = self.depart_return_split_count or len(self.segments)
+        return max(split - 1, len(self.segments) - split - 1)
+
+    def as_dict(self):
+        if self._template is None:
+            self._template = self.build_template()
+        return self._template
+
+    def durations(self):
+        # All the durations of the itinerary in seconds: (flight times, layover times, total travel times). The
+        # layover list is empty for a single flight, and the totals are [departure, return], like the template.
+        departures = [segment.departure_ts for segment in self.segments]
+        arrivals = [segment.arrival_ts for segment in self.segments]
+        flight_times = [arrival - departure for departure, arrival in zip(departures, arrivals)]
+        layover_times = []
+        if len(departures) > 1:
+            layover_times = layover_time_calc(departures, arrivals)
+        total_travel_times = total_travel_time_calc(departures, arrivals, self.depart_return_split_count)
+        return flight_times, layover_times, total_travel_times
+
+    def build_template(self):
+        # The times are only turned into strings here, when the itinerary is about to be shown.
+        segments = self.segments
+        depart_date, depart_time = date_and_time_split([segment.local_departure for segment in segments])
+        return_date, return_time = date_and_time_split([segment.local_arrival for segment in segments])
+        flight_times, layover_times, total_travel_times = self.durations()
+
+        flight_output = {
+            "price": self.price,
+            "city_from": [[segment.city_from, segment.city_code_from] for segment in segments],
+            "city_to": [[segment.city_to, segment.city_code_to] for segment in segments],
+            "depart_date": depart_date,
+            "depart_time": depart_time,
+            "return_date": return_date,
+            "return_time": return_time,
+            "flight_time": [format_duration(seconds) for seconds in flight_times],
+            "layover_time": [format_duration(seconds) for seconds in layover_times],
+            "total_travel_time": [format_duration(seconds) for seconds in total_travel_times],
+            "airline": [segment.airline for segment in segments],
+            "flight_num": [segment.flight_num for segment in segments],
+            "currency": self.currency
+        }
+        if self.flight_type == "round":
+            flight_output["depart_return_split_count"] = self.depart_return_split_count
+        return flight_output
+
+    def __getitem__(self, key):
+        return self.as_dict()[key]
+
+    def get(self, key, default=None):
+        return self.as_dict().get(key, default)
+
+
+def trim_itinerary(itinerary):
+    # An itinerary from a /v2/search response cut down to what Itinerary reads, eg: before it's cached.
+    return {"price": itinerary["price"],
+            "route": [{field: segment[field] for field in SEGMENT_FIELDS if field in segment}
+                      for segment in itinerary["route"]]}
+
+
+def return_split(segments, destination_city):
+    # Returns the index of the first segment of the return flight, or None if there isn't one. Tequila marks return
+    # segments with "return": 1; when that's missing, the return flight is the first segment leaving the destination
+    # city.
+    for count, segment in enumerate(segments):
+        if segment.is_return is None:
+            if segment.city_from == destination_city:
+                return count
+        elif segment.is_return:
+            return count
+    return None
+
+
+def timestamp_seconds(timestamp):
+    # Converts an API timestamp such as "2021-12-20T14:05:00.000Z" to seconds since the epoch. Seconds are dropped,
+    # since the times shown to the user are to the minute.
+    return int((datetime.fromisoformat(timestamp[:16]) - EPOCH).total_seconds())
+
+
+def format_duration(seconds):
+    # 11100 -> "3h05m". Durations of a day or more keep counting hours ("27h05m").
+    sign = "-" if seconds < 0 else ""
+    hours, minutes = divmod(abs(seconds) // 60, 60)
+    return f"{sign}{hours}h{minutes:02d}m"
+
+
+def total_travel_time_calc(departure_time, arrival_time, depart_return_split):
+    # Takes the departure and arrival times in seconds, and returns the departure and return travel times in seconds.
+    depart_total_time = arrival_time[depart_return_split - 1] - departure_time[0]
+    return_total_time = arrival_time[-1] - departure_time[depart_return_split]
+    return [depart_total_time, return_total_time]
+
+
+def layover_time_calc(depart_times, arrival_times):
+    # Takes the departure and arrival times in seconds, and returns the time in seconds between each arrival and the
+    # next departure.
+    return [depart_times[count + 1] - arrival_times[count] for count in range(0, len(depart_times) - 1)]
+
+
+def date_and_time_split(dates_and_times):
+    # "2021-12-20T14:05:00.000Z" -> "2021-12-20" and "14:05"
+    dates = []
+    times = []
+    for date_time in dates_and_times:
+        dates.append(date_time[0:10])
+        times.append(date_time[11:16])
+    return dates, times
@@ -1,16 +1,94 @@
-from flask import Flask, render_template, url_for, redirect, flash, request
+from flask import Flask, render_template, url_for, redirect, flash, request, abort, Response, stream_with_context, \
+    jsonify
 from flask_bootstrap import Bootstrap
-from forms import FlightSearchForm
-from flight_search import FlightSearch
+from flight_search import FlightSearch, search_stopover_tiers, search_stopover_tiers_progressive, search_single_call, \
+    search_price_calendar, check_search, search_parameters, iata_cache, search_cache, tequila_client, rate_limiter, \
+    search_requests, city_lookups
+from rate_limiter import RateLimitExceeded
+from batch_search import run_batch, BatchSearchError
+from deal_watch import deal_watch_store
+from metrics import metrics
+import json
+import time
 import os
-from datetime import datetime, timedelta
+from datetime import timedelta
+from jinja2 import FileSystemBytecodeCache
 
 
 app = Flask(__name__)
 # CSRF_TOKEN to use FlaskForms - stored as env variable
 app.config["SECRET_KEY"] = os.environ['CSRF_TOKEN']
+# Run the stopover searches for a trip at the same time rather than one after another. Set CONCURRENT_SEARCH=0 to go
+# back to sequential searches.
+app.config["CONCURRENT_SEARCH"] = os.environ.get("CONCURRENT_SEARCH", "1") != "0"
+# Make a single flight search allowing the most stopovers, and pick out the most direct and cheapest flights from all
+# the flights it returns, instead of making one search per number of stopovers. Set SINGLE_CALL_SEARCH=1 to enable.
+app.config["SINGLE_CALL_SEARCH"] = os.environ.get("SINGLE_CALL_SEARCH", "0") == "1"
+# Send the results page as soon as the search starts, and stream each flight into it as it's found: the most direct
+# flight first, then each cheaper flight as the stopover searches come back. Set PROGRESSIVE_RESULTS=1 to enable. This
+# only applies to concurrent stopover searches, since a single-call search finds every flight at once.
+app.config["PROGRESSIVE_RESULTS"] = os.environ.get("PROGRESSIVE_RESULTS", "0") == "1"
 # Enable Bootstrap for WTForms
 Bootstrap(app)
+# Jinja compiles each template the first time it's used. The compiled templates are also kept on disk (in the
+# JINJA_BYTECODE_CACHE folder, or the system's temporary folder by default), so a restarted worker loads them instead of
+# compiling them again. Set JINJA_BYTECODE_CACHE=0 to turn this off.
+if os.environ.get("JINJA_BYTECODE_CACHE") != "0":
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.environ.get("JINJA_BYTECODE_CACHE") or None)
+
+
+def preload():
+    # Loads everything the first requests would otherwise load: the modules that are imported lazily and every
+    # template. With PRELOAD_APP=1 this runs when the app is imported, which together with gunicorn's --preload (see
+    # gunicorn.conf.py) means it's done once in the gunicorn master, and every worker starts with it already loaded.
+    import forms
+    import requests
+    for template_name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(template_name)
+
+
+# When METRICS_ENABLED=1, each request records how long its phases and Tequila API calls took (see metrics.py), and
+# sends the totals back in a Server-Timing header, which shows up in the browser's developer tools.
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+@app.after_request
+def add_server_timing(response):
+    server_timing = metrics.server_timing()
+    if server_timing:
+        response.headers["Server-Timing"] = server_timing
+    return response
+
+# Route for the metrics of this worker process, in the Prometheus text format. Along with the recorded timings, it
+# includes the cache hit/miss counters and the Tequila connection pool counters.
+@app.route("/metrics")
+def metrics_endpoint():
+    if not metrics.enabled:
+        abort(404)
+    gauges = []
+    for name, value in iata_cache.stats().items():
+        gauges.append((f"iata_cache_{name}", (), value))
+    if search_cache is not None:
+        for name, value in search_cache.stats().items():
+            gauges.append((f"search_cache_{name}", (), value))
+    for name, value in tequila_client.stats().items():
+        gauges.append((f"tequila_client_{name}", (), value))
+    if rate_limiter is not None:
+        for name, value in rate_limiter.stats().items():
+            gauges.append((f"tequila_rate_limit_{name}", (), value))
+    for name, value in search_requests.stats().items():
+        gauges.append((f"tequila_coalesced_searches_{name}", (), value))
+    for name, value in city_lookups.stats().items():
+        gauges.append((f"tequila_coalesced_city_lookups_{name}", (), value))
+    return metrics.render(gauges), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+# When the Tequila API is too busy for a search to wait its turn (see TEQUILA_RATE_LIMIT in flight_search.py), the
+# user is sent back to the search page to try again.
+@app.errorhandler(RateLimitExceeded)
+def rate_limit_exceeded(error):
+    flash("We're getting a lot of searches right now. Please try your search again in a moment.")
+    return redirect(request.path)
 
 # Route for home page
 @app.route("/")
@@ -21,222 +99,222 @@ def home():
 # user chooses on the home page.
 @app.route(f"/<string:trip_type>_trip_search", methods=["GET", "POST"])
 def trip_search(trip_type):
-    # form imported from forms.py
+    # form imported from forms.py. WTForms is only imported by the first search, since other pages don't need it.
+    from forms import FlightSearchForm
     form = FlightSearchForm()
     # User clicks and begins the flight search and we receive a POST request.
-    # We will start with most_direct_flight and cheapest_flight as empty dics and fill them with the data to be
-    # sent to the Tequila API to retrieve the flight data.
     # error_message will begin as None and be assigned data if an error message is needed. This will pop up on the
     # search results page if a flight cannot be found for the user's search criteria.
     if request.method == "POST":
-        most_direct_flight = {}
-        cheapest_flight = {}
         error_message = None
+        # date_to is only needed for round trip searches, as a one-way trip search will not need a second date (only
+        # requires departure date), so it's None for one-way trips.
         date_from = form.date_from.data
-        # date_to will initially be assigned None so we've at least declared the variable, as it's needed for future
-        # if statements below. However, date_to is only needed for round trip searches, as a one-way trip search will
-        # not need a second date (only requires departure date).
-        date_to = None
-        adults = form.adults.data
-        children = form.children.data
-        infants = form.infants.data
-        flight_type = trip_type
+        date_to = form.date_to.data if trip_type == "round" else None
         currency = form.currency.data
-        # We receive date_from initially as a datetime object formatted %Y/%m/%d. The Tequila API requires the date
-        # to be passed as a string, with the format %d/%m/%Y, so we create a new string, and reformat it for the API.
-        date_from_string = date_from.strftime("%d/%m/%Y")
-
-        # If the user is wanting to do a round trip search, the API will require these additional data fields:
-        # date_to is the date for the return flight
-        # nights_stay is required for round_trip searches by the Tequila API. We will get the delta between the
-        # date_to and date_from datetime variables.
-        # date_to_string, like date_from_string, will convert the datetime to the required string with the proper format
-        # for the API.
-        if trip_type == "round":
-            date_to = form.date_to.data
-            nights_stay = (date_to - date_from).days
-            date_to_string = date_to.strftime("%d/%m/%Y")
-
-        # The following if statements are to catch errors caused by the user inputs.
-
-        # We retrieve today and tomorrow's dates for the date inputs and search criteria for the flight dates.
-        today = datetime.today().date()
-        tomorrow = today + timedelta(days=1)
-
-        # We will allow the user to begin searches starting from tomorrow/next day, since users will rarely search for
-        # flights on same day. if date_from is before tomorrow's date, the search will not go through.
-        if tomorrow > date_from:
-            # We add this if statement for round flight searches where date_to is True, and check to make sure date_to's
-            # date is not before tomorrow's date as well.
-            if date_to:
-                if tomorrow > date_to:
-                    flash("Your travel dates cannot be before tomorrow's date.")
-                    return redirect(url_for("trip_search", trip_type=trip_type))
-            # else statement to capture one way flight searches
-            else:
-                flash("Your travel dates cannot be before tomorrow's date.")
-                return redirect(url_for("trip_search", trip_type=trip_type))
-
-        # For round trip flight searches, the return date cannot be before the departure date.
-        if trip_type == "round":
-            if date_from > date_to:
-                flash("You may not have a return date earlier than your departure date.")
-                return redirect(url_for("trip_search", trip_type=trip_type))
-
-        # The Tequila API will only allow searches to a max of 9 passengers.
-        if int(adults) + int(children) + int(infants) > 9:
-            flash("You may only search for flights with a total of 9 passengers.")
+        search = {
+            "date_from": date_from,
+            "date_to": date_to,
+            "adults": form.adults.data,
+            "children": form.children.data,
+            "infants": form.infants.data,
+            "flight_type": trip_type,
+            "currency": currency
+        }
+
+        # We catch errors caused by the user inputs (travel dates before tomorrow, a return date before the
+        # departure date or more than 9 passengers) before making any calls, see check_search in flight_search.py.
+        try:
+            check_search(search)
+        except ValueError as error:
+            flash(str(error))
             return redirect(url_for("trip_search", trip_type=trip_type))
 
         # We initially will make a call to the Tequila API to retrieve the correct city/airport from the user's input.
-        # Because the call is within the for loop below, and we do not need to repeatedly make the call once we've
-        # retrieved the information the first time, once we get the city information, we will turn city_code_depart and
-        # city_code_destination to True, and no longer make the API calls specifically for city data.
-        # This will speed up the application and flight searches.
-        city_code_depart = False
-        city_code_destination = False
-        
-        # If we find a most_direct_flight, found_most_direct_flight will be turned True, and we will set x to the
-        # highest iteration futher below as we are only then interested in the cheapest flight, so we'll max out
-        # the number of stopovers allowed, and the first flight returned will be the cheapest available.
-        found_most_direct_flight = False
-
-        # We will do 6 flight searches (range(0, 6)). The count iteration pertains to the number of max
-        # stopovers/layovers we will pass to the Tequila API. We care about increasing the number of stops because
-        # we are returning the cheapest flight possible to the user, these flight routes generally have a larger number
-        # of stopovers. I've found the largest number of stopovers for a flight to some of the most remote regions is
-        # usually 4 (for a single flight direction), so I've gone up to 5 stopovers just to be more inclusive in case
-        # there is a change for a flight with 5 stopovers.
-        for x in range(0, 6):
-            # We will use OOP and create a new flight_search object for each flight. This allows us to re-initialize all
-            # the flight data to empty/None and retrieve new data to compare to our existing data (ie: if the new flight
-            # is cheaper than the currently stored one, we will replace the old flight data with the new flight data).
-            flight_search = FlightSearch()
-            # As mentioned, we will increase the stopovers allowed based on the loop iteration.
-            stopovers = x
-            # As mentioned, because we only need to retrieve the city data once, we initially set a False variable,
-            # and will turn it True once we get the desired city data.
-            # For both departure and destination city, we will have a try/except block. We will try to retrieve the
-            # city data based on the user's input. Although the Tequila API city/airport search is quite robust with
-            # spelling errors, this try/except will catch inputs will large errors/inaccuracies. Our algorithm also only
-            # searches based on cities, so if the user inputs a province/state or country, the program would normally
-            # crash. With the try/except, we will instead return an error and give the user an opportunity to fix their
-            # input.
-            if not city_code_depart:
-                try:
-                    departure_city, departure_city_iata = flight_search.city_iata_search(form.departure_city.data)
-                    city_code_depart = True
-                except KeyError:
-                    flash("The departure city you entered could not be found. Please ensure the spelling of the "
-                          "city or the three letter airport IATA code is correct.")
-                    return redirect(url_for("trip_search", trip_type=trip_type))
-            if not city_code_destination:
-                try:
-                    destination_city, destination_city_iata = flight_search.city_iata_search(form.destination_city.data)
-                    city_code_destination = True
-                except KeyError:
-                    flash("The destination city you entered could not be found. Please ensure the spelling of the "
-                          "city or the three letter airport IATA code is correct.")
-                    return redirect(url_for("trip_search", trip_type=trip_type))
-
-            # Once we get the the correct city/airport data from the Tequila API based on the user's input, we will
-            # start the flight search through the Tequila API. The search is within a try/except block in case the API
-            # does not return a flight based on the user's parameters.
-
-            # The search algorithm and data is done via OOP, see flight_search.py for the details on how the search
-            # functions.
-
-            # These are the parameters we will pass to the Tequila API.
-            # fly_from = the departure city airport IATA code
-            # fly_to = destination city airport IATA code
-            # date_from and date_to: Tequila will search the departure date based on a range of dates (date_from to
-                # date_to), however, we are only interested in flights with a single departure date (based on the user
-                # input). Because the API requires both of these parameters, we will pass the same date for both.
-            # adults, children, infants = number of each type of passenger
-            # flight_type = "oneway" or "round"
-            # max_sector_stopovers = The maximum number of stopovers allowed per flight route search
-            # curr = the currency for the flight_search cost. We allow CAD, USD, and EUR.
-            try:
-                parameters = {
-                    "fly_from": departure_city_iata,
-                    "fly_to": destination_city_iata,
-                    "date_from": date_from_string,
-                    "date_to": date_from_string,
-                    "adults": adults,
-                    "children": children,
-                    "infants": infants,
-                    "flight_type": flight_type,
-                    "max_sector_stopovers": stopovers,
-                    "curr": currency
-                }
-
-                # If we are doing a round trip search, we require these additional parameters to be added on
-                # return_from and return_to:
-                #  like explained above for date_from and date_to but for the return date.
-
-                # nights_in_dst_from and nights_in_dst_to:
-                #   For round trip searches, Tequila API requires these parameters. It's the range of dates the
-                #   traveller is willing to stay before their return flight. Because we assume based on their depart
-                #   and return dates they gave, that that would intuitively be the number of nights they would like
-                #   to stay. We +/- 2 nights to add a little more robustness to the flight search. This is mainly
-                #   for overseas flights as cheaper flights will generally require an overnight stay at a stopover.
-                if trip_type == "round":
-                    parameters["return_from"] = date_to_string
-                    parameters["return_to"] = date_to_string
-                    parameters["nights_in_dst_from"] = (nights_stay - 2)
-                    parameters["nights_in_dst_to"] = (nights_stay + 2)
-
-                # We pass the parameters and destination_city to the flight_search method in flight_search.py
-                # We pass destination_city separately since it's used to determine the round flight
-                # departure/return "split". Because the flights are returned as a list of flights, it is not obvious
-                # where the 'split' occurs. Therefore, we use the destination city in our algorithm to determine this.)
-                flight = flight_search.flight_search(parameters, destination_city)
-
-                # First, we work to find the cheapest_flight. Because we are looking at up to 5 flight routes (each with
-                # increasing number of stopovers), we will check each subsequent flight's price to see if it's cheaper
-                # than what we've previously recorded as the cheapest flight.
-
-                # The first if statement will assign the first flight as the cheapest_flight
-                if flight["price"] and not cheapest_flight:
-                    cheapest_flight = flight
-
-                # Each subsequent flight_search will compare its price to the price we have currently have assigned to
-                # cheapest_flight. If the new flight price is lower, we will assign the new flight to cheapest_flight.
-                elif flight["price"] and cheapest_flight:
-                    if flight["price"] < cheapest_flight["price"]:
-                        cheapest_flight = flight
-
-                # Because each subsequent flight_search will increase the possible number of stopovers. We're only
-                # interested in the first flight_search that returns a True result for the most_direct_flight.
-                # This way, the user will be returned both the most_direct_flight and cheapest_flight to compare.
-                if flight["price"] and not most_direct_flight:
-                    most_direct_flight = flight
-                    found_most_direct_flight = True
-                
-                if most_direct_flight and found_most_direct_flight:
-                    x = 4
-            # As mentioned previously, I found roughly 4 stopovers to be the max number required to fly anywhere in the
-            # world from location. Therefore, allowed the search algorithm to go up to 5 stopovers. If a flight was not
-            # found and returned after this many searches, it's most likely that a flight does not currently exist for
-            # the user's input parameters. The most likely scenario is the user's search dates are too far out into the
-            # future, and flights for those departure/destination cities have not yet been established.
-
-            # The if/else statement will finally record something when stopovers/x == 5. Otherwise, the except block
-            # may still catch errors when flights were not found, but the else statement allows the for loop to
-            # continue. For example, when x == 0, aka trying to find flights with 0 stopovers, this is most likely not
-            # possible for overseas flights if you are not flying out from main international hubs, so we will enter
-            # the except block, but because x != 5, we will continue from the else statement, and increase x by 1 in
-            # the for loop.
-
-            except IndexError:
-                if x == 5:
-                    error_message = "Sorry, there are no available flights for this destination with these dates."
+        # We only need the city information once per search, so both lookups happen before any flight searches.
+        # For both departure and destination city, we will have a try/except block. We will try to retrieve the
+        # city data based on the user's input. Although the Tequila API city/airport search is quite robust with
+        # spelling errors, this try/except will catch inputs will large errors/inaccuracies. Our algorithm also only
+        # searches based on cities, so if the user inputs a province/state or country, the program would normally
+        # crash. With the try/except, we will instead return an error and give the user an opportunity to fix their
+        # input.
+        flight_search = FlightSearch()
+        try:
+            with metrics.phase("iata"):
+                departure_city, departure_city_iata = flight_search.city_iata_search(form.departure_city.data)
+        except KeyError:
+            flash("The departure city you entered could not be found. Please ensure the spelling of the "
+                  "city or the three letter airport IATA code is correct.")
+            return redirect(url_for("trip_search", trip_type=trip_type))
+        try:
+            with metrics.phase("iata"):
+                destination_city, destination_city_iata = flight_search.city_iata_search(form.destination_city.data)
+        except KeyError:
+            flash("The destination city you entered could not be found. Please ensure the spelling of the "
+                  "city or the three letter airport IATA code is correct.")
+            return redirect(url_for("trip_search", trip_type=trip_type))
+
+        # Once we get the the correct city/airport data from the Tequila API based on the user's input, we will
+        # start the flight search through the Tequila API.
+
+        # These are the parameters we will pass to the Tequila API, see search_parameters in flight_search.py.
+        parameters = search_parameters(search, departure_city_iata, destination_city_iata)
+
+        # If the user's dates are flexible, we show the cheapest fare for each day of the next flexible_days days
+        # (counting the chosen date as the first) instead. We make a single flight search covering the whole range of
+        # dates (date_from to date_to, and return_from to return_to for round trips, both inclusive), rather than a
+        # set of searches for each day. Only the choices offered on the form are accepted.
+        flexible_days = form.flexible_days.data
+        if flexible_days in dict(form.flexible_days.choices) and flexible_days:
+            parameters["date_to"] = (date_from + timedelta(days=flexible_days - 1)).strftime("%d/%m/%Y")
+            if trip_type == "round":
+                parameters["return_to"] = (date_to + timedelta(days=flexible_days - 1)).strftime("%d/%m/%Y")
+            with metrics.phase("search"):
+                calendar = search_price_calendar(parameters, destination_city)
+
+            # For one-way trips, every day of the range gets a row, with None as the flight for days without any.
+            if trip_type == "oneway":
+                flights_by_day = {depart_date: flight for depart_date, return_date, flight in calendar}
+                calendar = []
+                for day in range(0, flexible_days):
+                    depart_date = (date_from + timedelta(days=day)).isoformat()
+                    calendar.append((depart_date, None, flights_by_day.get(depart_date)))
+            prices = [flight.price for depart_date, return_date, flight in calendar if flight]
+            cheapest_price = min(prices, default=None)
+            if not prices:
+                error_message = "Sorry, there are no available flights for this destination with these dates."
+            with metrics.phase("render"):
+                return render_template("price_calendar.html", calendar=calendar, cheapest_price=cheapest_price,
+                                       departure_city=departure_city, destination_city=destination_city,
+                                       currency=currency, error_message=error_message, trip_type=trip_type)
+
+        # We will do 6 flight searches, one for each max_sector_stopovers value from 0 to 5. We care about increasing
+        # the number of stops because we are returning the cheapest flight possible to the user, these flight routes
+        # generally have a larger number of stopovers. I've found the largest number of stopovers for a flight to
+        # some of the most remote regions is usually 4 (for a single flight direction), so I've gone up to 5
+        # stopovers just to be more inclusive in case there is a change for a flight with 5 stopovers.
+
+        # The most_direct_flight is the flight from the search with the fewest stopovers that returns a flight, and
+        # the cheapest_flight is the cheapest flight across all 6 searches. This way, the user will be returned both
+        # the most_direct_flight and cheapest_flight to compare.
+
+        # With CONCURRENT_SEARCH enabled, the 6 searches are sent to the Tequila API at the same time instead of
+        # one after another, so the user only waits about as long as the slowest single search.
+        # With SINGLE_CALL_SEARCH enabled, only the search allowing 5 stopovers is made, and the most direct flight is
+        # found among all the flights it returns.
+
+        # We pass destination_city separately since it's used to determine the round flight
+        # departure/return "split". Because the flights are returned as a list of flights, it is not obvious
+        # where the 'split' occurs. Therefore, we use the destination city in our algorithm to determine this.)
+        # The search algorithm and data is done via OOP, see flight_search.py for the details on how the search
+        # functions.
+        # If the deal watch tracks this route and dates (see deal_watch.py), it has already found the flights in the
+        # background, and we show those instead of searching again.
+        tracked_fares = None
+        if deal_watch_store is not None:
+            tracked_fares = deal_watch_store.latest_fares(parameters)
+        if tracked_fares is not None:
+            most_direct_flight, cheapest_flight = tracked_fares
+            metrics.increment("deal_watch_hits_total")
+        elif app.config["PROGRESSIVE_RESULTS"] and app.config["CONCURRENT_SEARCH"] and \
+                not app.config["SINGLE_CALL_SEARCH"]:
+            return stream_template("flight_info.html", progressive=True, trip_type=trip_type,
+                                   updates=progressive_updates(parameters, destination_city))
+        else:
+            with metrics.phase("search"):
+                if app.config["SINGLE_CALL_SEARCH"]:
+                    most_direct_flight, cheapest_flight, flights_by_stopovers = search_single_call(parameters,
+                                                                                                   destination_city)
                 else:
-                    continue
+                    most_direct_flight, cheapest_flight = search_stopover_tiers(
+                        parameters, destination_city, concurrent=app.config["CONCURRENT_SEARCH"])
+
+        # If none of the searches returned a flight, it's most likely that a flight does not currently exist for
+        # the user's input parameters. The most likely scenario is the user's search dates are too far out into the
+        # future, and flights for those departure/destination cities have not yet been established.
+        if not most_direct_flight:
+            error_message = "Sorry, there are no available flights for this destination with these dates."
 
-        return render_template("flight_info.html", most_direct_flight=most_direct_flight, cheapest_flight=cheapest_flight, error_message=error_message,
-                               trip_type=trip_type)
+        with metrics.phase("render"):
+            return render_template("flight_info.html", most_direct_flight=most_direct_flight,
+                                   cheapest_flight=cheapest_flight, error_message=error_message, trip_type=trip_type)
     return render_template("trip_search.html", form=form, trip_type=trip_type)
 
+def stream_template(template_name, **context):
+    # Renders a template a piece at a time, sending each piece to the browser as soon as it's ready, so a template
+    # looping over a generator shows each item as the generator produces it.
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.generate(context)), headers={"X-Accel-Buffering": "no"})
+
+def progressive_updates(parameters, destination_city):
+    # The updates streamed into a progressive flight_info.html (see flight_update.html), in the order the flights
+    # are found by search_stopover_tiers_progressive. The updates are rendered one at a time as the search goes, so
+    # their render times are added up and recorded as one "render" phase once the page is done.
+    render_seconds = 0.0
+
+    def render_update(**context):
+        nonlocal render_seconds
+        started = time.perf_counter()
+        try:
+            return render_template("flight_update.html", **context)
+        finally:
+            render_seconds += time.perf_counter() - started
+
+    try:
+        with metrics.phase("search"):
+            for event, result in search_stopover_tiers_progressive(parameters, destination_city):
+                if event == "most_direct":
+                    yield render_update(section="most-direct-flight", flight=result, heading="Most direct route:",
+                                        name="TripDirect", direct_return_label="(Direct Flight)")
+                elif event == "cheapest":
+                    yield render_update(section="cheapest-flight", flight=result, heading="Cheapest flight route:",
+                                        name="TripCheap", searching=True)
+                else:
+                    most_direct_flight, cheapest_flight = result
+        if not most_direct_flight:
+            yield render_update(section="flight-results",
+                                error_message="Sorry, there are no available flights for this destination with "
+                                              "these dates.")
+            return
+        # The search is done, so the cheapest flight found is the final one.
+        yield render_update(section="cheapest-flight", flight=cheapest_flight, heading="Cheapest flight route:",
+                            name="TripCheap")
+        if cheapest_flight["price"] == most_direct_flight["price"] and \
+                cheapest_flight["total_travel_time"] == most_direct_flight["total_travel_time"]:
+            yield render_update(section="most-direct-flight", same_flight=True)
+    except RateLimitExceeded:
+        yield render_update(section="flight-results",
+                            error_message="We're getting a lot of searches right now. Please try your search again "
+                                          "in a moment.")
+    finally:
+        metrics.record_phase("render", render_seconds)
+
+# Route for searching many trips at once, eg: {"searches": [{"from": "Toronto", "to": "London", "date_from": "2026-11-03",
+# "date_to": "2026-11-10"}, ...]}. See batch_search.parse_search for the fields of a search. Each result is sent back as
+# soon as its search finishes, as one JSON object per line, or as server-sent events if the client asks for
+# text/event-stream. Results carry the "index" of their search, since they don't come back in order.
+@app.route("/api/batch_search", methods=["POST"])
+def batch_search():
+    try:
+        results = run_batch(request.get_json(silent=True))
+    except BatchSearchError as error:
+        return jsonify({"error": str(error)}), 400
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        def stream():
+            for result in results:
+                yield f"data: {json.dumps(result)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    def stream():
+        for result in results:
+            yield json.dumps(result) + "\n"
+    return Response(stream_with_context(stream()), mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no"})
+
+if os.environ.get("PRELOAD_APP") == "1":
+    preload()
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000)
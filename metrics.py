@@ -0,0 +1,151 @@
+from contextlib import contextmanager, nullcontext
+import contextvars
+import threading
+import time
+import os
+
+# Upper bounds of the histogram buckets, for timings (seconds) and response sizes (bytes).
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# The spans recorded while serving the current request, or None outside of a request. Search threads are started
+# with a copy of the request's context (see run_in_context), so their spans land in the same list.
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    # Counters and histograms for the Tequila API calls and the phases of a search, kept per worker process, plus a
+    # per-request list of spans sent back in the Server-Timing header. When disabled, every method returns straight
+    # away and phase() hands back a shared no-op context manager.
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, labels=(), amount=1):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=(), buckets=SECONDS_BUCKETS):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def phase(self, name):
+        # Times a phase of a search (eg: "iata", "search", "parse", "render").
+        if not self.enabled:
+            return nullcontext()
+        return self.timed_phase(name)
+
+    @contextmanager
+    def timed_phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - started)
+
+    def record_phase(self, name, elapsed):
+        # Records a phase timed by the caller, eg: one made up of several pieces that are timed separately.
+        if not self.enabled:
+            return
+        self.observe("flight_search_phase_seconds", elapsed, (("phase", name),))
+        self.add_span(name, elapsed)
+
+    def record_upstream(self, endpoint, parameters, status, elapsed, payload_bytes):
+        # One call to the Tequila API. stopovers is the max_sector_stopovers searched, when there is one.
+        if not self.enabled:
+            return
+        stopovers = str((parameters or {}).get("max_sector_stopovers", ""))
+        self.observe("tequila_request_seconds", elapsed, (("endpoint", endpoint), ("stopovers", stopovers)))
+        self.observe("tequila_response_bytes", payload_bytes, (("endpoint", endpoint),), buckets=BYTES_BUCKETS)
+        self.increment("tequila_requests_total", (("endpoint", endpoint), ("status", str(status))))
+        self.add_span("tequila", elapsed)
+
+    def add_span(self, name, elapsed):
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((name, elapsed))
+
+    def start_request(self):
+        if self.enabled:
+            _request_spans.set([])
+
+    def server_timing(self):
+        # Sums the spans of the current request by name, eg: 'iata;dur=1.2, tequila;desc="6 calls";dur=2404.1'.
+        # The tequila calls of a concurrent search overlap, so their total can be more than the search took.
+        spans = _request_spans.get()
+        if not spans:
+            return None
+        totals = {}
+        counts = {}
+        for name, elapsed in spans:
+            totals[name] = totals.get(name, 0) + elapsed
+            counts[name] = counts.get(name, 0) + 1
+        entries = []
+        for name, total in totals.items():
+            description = f';desc="{counts[name]} calls"' if name == "tequila" else ""
+            entries.append(f"{name}{description};dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+    def render(self, gauges=()):
+        # Prometheus text format. gauges is a list of (name, labels, value) for values owned by other objects, such as
+        # the cache and connection pool counters.
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            for (name, labels), value in counters:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in histograms:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        for name, labels, value in gauges:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def run_in_context(function):
+    # Wraps function so it runs with a copy of the caller's context, which carries the current request's spans into
+    # the search threads.
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+# Set METRICS_ENABLED=1 to record metrics, serve them at /metrics and add a Server-Timing header to responses.
+metrics = Metrics(os.environ.get("METRICS_ENABLED", "0") == "1")
@@ -0,0 +1,96 @@
+from cache import SQLiteConnections
+import threading
+import time
+
+
+class RateLimitExceeded(Exception):
+    # Raised when a call would have to wait longer than the limiter's max_wait for its turn.
+    pass
+
+
+def take_token(tokens, updated_at, now, rate, burst, max_wait):
+    # Token bucket maths shared by both limiters. The bucket refills at rate tokens a second, up to burst tokens. A
+    # call always takes a token, letting the bucket go negative, and waits until the bucket is back to zero, so
+    # waiting calls are served in the order they arrived. Returns (tokens, wait), or None if the wait would be over
+    # max_wait (in which case no token is taken).
+    tokens = min(burst, tokens + (now - updated_at) * rate) - 1
+    wait = max(0.0, -tokens / rate)
+    if wait > max_wait:
+        return None
+    return tokens, wait
+
+
+class TokenBucket:
+    # Limits the calls made by this process to rate a second, allowing bursts of up to burst calls.
+    def __init__(self, rate, burst, max_wait=10):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.tokens = burst
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+        self.counters = {"acquired": 0, "delayed": 0, "rejected": 0, "wait_seconds": 0.0}
+
+    def reserve(self):
+        with self.lock:
+            now = time.time()
+            taken = take_token(self.tokens, self.updated_at, now, self.rate, self.burst, self.max_wait)
+            if taken is not None:
+                self.tokens, wait = taken
+                self.updated_at = now
+                return wait
+            return None
+
+    def acquire(self):
+        # Blocks until this call's turn. Raises RateLimitExceeded if that's more than max_wait seconds away.
+        wait = self.reserve()
+        with self.lock:
+            if wait is None:
+                self.counters["rejected"] += 1
+            else:
+                self.counters["acquired"] += 1
+                if wait > 0:
+                    self.counters["delayed"] += 1
+                    self.counters["wait_seconds"] += wait
+        if wait is None:
+            raise RateLimitExceeded(f"over {self.rate} calls a second")
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class SQLiteTokenBucket(TokenBucket):
+    # A TokenBucket kept in a SQLite file, so the limit is shared by every gunicorn worker on the machine. Each call
+    # updates the bucket's row inside a write transaction, so concurrent workers can't take the same token. The
+    # counters in stats() are still per process.
+    def __init__(self, path, name, rate, burst, max_wait=10):
+        super().__init__(rate, burst, max_wait)
+        self.path = path
+        self.name = name
+        self.connections = SQLiteConnections(path, [
+            "CREATE TABLE IF NOT EXISTS token_buckets (name TEXT PRIMARY KEY, tokens REAL, updated_at REAL)",
+        ])
+
+    def reserve(self):
+        connection = self.connections.get()
+        # BEGIN IMMEDIATE takes the database's write lock up front, so the read and the update below can't interleave
+        # with another worker's.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated_at FROM token_buckets WHERE name = ?",
+                                     (self.name,)).fetchone()
+            now = time.time()
+            tokens, updated_at = row if row is not None else (self.burst, now)
+            taken = take_token(tokens, updated_at, now, self.rate, self.burst, self.max_wait)
+            if taken is not None:
+                connection.execute("INSERT OR REPLACE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                                   (self.name, taken[0], now))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return None if taken is None else taken[1]
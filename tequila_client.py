@@ -0,0 +1,107 @@
+from metrics import metrics
+import threading
+import time
+import os
+
+
+class SearchCancelled(Exception):
+    # Raised instead of sending a call whose search no longer needs its answer (see TequilaClient.get).
+    pass
+
+
+class TequilaClient:
+    # Shared HTTP client for the Tequila API. It keeps a pool of keep-alive connections so that each search doesn't
+    # pay for a new TCP + TLS handshake, and retries with exponential backoff when the API answers 429 or 5xx
+    # (respecting Retry-After, up to max_retry_after seconds, since the wait holds a search thread and can't be
+    # cancelled). Once the retries run out the last response is returned as-is, so callers still see the API's error
+    # body. If a rate_limiter is given (see rate_limiter.py), every call waits for its turn before it's
+    # sent. Retries made by urllib3 don't go back through the limiter, they're spaced out by the backoff instead.
+    def __init__(self, base_url, api_key, pool_size=10, connect_timeout=3.05, read_timeout=30, retries=2,
+                 backoff_factor=0.5, max_retry_after=2, rate_limiter=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_after = max_retry_after
+        self.rate_limiter = rate_limiter
+        self.session = None
+        self.adapter = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        # Sessions are built lazily, and rebuilt after a fork, so gunicorn workers never share pooled sockets.
+        # requests is only imported here, since it's slow to import and pages that don't search don't need it.
+        with self.lock:
+            if self.pid != os.getpid():
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                max_retry_after = self.max_retry_after
+
+                class CappedRetry(Retry):
+                    # urllib3 sleeps for as long as Retry-After asks, so a long one is cut down to max_retry_after.
+                    def get_retry_after(self, response):
+                        retry_after = super().get_retry_after(response)
+                        return None if retry_after is None else min(retry_after, max_retry_after)
+
+                retry = CappedRetry(total=self.retries, backoff_factor=self.backoff_factor,
+                              status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(["GET"]),
+                              respect_retry_after_header=True, raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.headers["apikey"] = self.api_key
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.session = session
+                self.adapter = adapter
+                self.pid = os.getpid()
+            return self.session
+
+    def get(self, path, params=None, cancelled=None):
+        # cancelled is an optional threading.Event, set once the caller no longer needs the answer. It's checked before
+        # taking a token from the rate limiter and again before the call is sent (the limiter may have made it wait),
+        # and SearchCancelled is raised instead of making the call. Calls that have already been sent can't be stopped.
+        if self.rate_limiter is not None:
+            self.check_cancelled(cancelled)
+            wait = self.rate_limiter.acquire()
+            if wait:
+                metrics.add_span("rate_limit", wait)
+        self.check_cancelled(cancelled)
+        if not metrics.enabled:
+            return self.get_session().get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+        started = time.perf_counter()
+        status = "error"
+        payload_bytes = 0
+        try:
+            response = self.get_session().get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+            status = response.status_code
+            payload_bytes = len(response.content)
+            return response
+        finally:
+            metrics.record_upstream(path, params, status, time.perf_counter() - started, payload_bytes)
+
+    def check_cancelled(self, cancelled):
+        if cancelled is not None and cancelled.is_set():
+            metrics.increment("tequila_requests_cancelled_total")
+            raise SearchCancelled()
+
+    def stats(self):
+        # urllib3 counts the requests sent and the connections opened by each pool, so every request above the
+        # number of connections opened went out over a reused connection.
+        requests_sent = 0
+        connections_opened = 0
+        if self.adapter is not None and self.pid == os.getpid():
+            pools = self.adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+        return {
+            "requests": requests_sent,
+            "connections_opened": connections_opened,
+            "connections_reused": max(requests_sent - connections_opened, 0),
+            "pool_size": self.pool_size,
+        }